@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of RCr and copyright (C) Maik Gosenshuis and 
+# Jeroen Tietema 2008-09.
+#
+# RCr is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RCr is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RCr.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Packs the images of the car parts and the user interface into a few large
+textures, so drawing them binds one or two textures instead of one for every
+image.
+
+The images listed in parts/*.cfg and the images in IMAGE_FOLDER are packed
+into pages of PAGE_SIZE x PAGE_SIZE pixels the first time the game starts.
+The pages are stored in the cache folder with an index of the region of
+every image, and later starts load them as they are. The pages are packed
+again when any of the images changes.
+"""
+
+import os
+import glob
+import hashlib
+import json
+from ConfigParser import RawConfigParser
+
+import numpy
+import pyglet.image
+import pyglet.resource
+from pyglet.image.atlas import Allocator, AllocatorException
+from pyglet.image.codecs import ImageDecodeException
+
+import cache
+
+
+__all__ = ['manager']
+
+
+# Changes when the way the pages are packed changes, so pages packed by older
+# versions are packed again.
+VERSION = 1
+
+# The width and height of a page in pixels. Images that do not fit on a page
+# are loaded into their own texture.
+PAGE_SIZE = 1024
+
+# The transparent pixels around every image, so the texture filtering at the
+# edges of a rotated sprite does not pick up its neighbours.
+PADDING = 2
+
+IMAGE_FOLDER = 'img'
+
+
+def get_image_names():
+    """Returns the sorted resource names of the images of the parts and of
+       the images in IMAGE_FOLDER."""
+    names = set([os.path.basename(path)
+        for path in glob.glob(os.path.join(IMAGE_FOLDER, '*.png'))])
+    
+    for path in glob.glob(os.path.join('parts', '*.cfg')):
+        config = RawConfigParser()
+        config.read(path)
+        for section in config.sections():
+            if config.has_option(section, 'image'):
+                names.add(config.get(section, 'image'))
+    
+    return sorted(names)
+
+
+def get_filename(name):
+    """Returns the file of an image found by pyglet.resource."""
+    return os.path.join(pyglet.resource.location(name).path, name)
+
+
+def get_atlas_key(names):
+    """Returns a key identifying the current contents of a set of images and
+       the way they are packed."""
+    digest = hashlib.md5('%d-%d-%d' % (VERSION, PAGE_SIZE, PADDING))
+    for name in names:
+        digest.update('%s:%s;' % (name, cache.get_cache_key(get_filename(name))))
+    return digest.hexdigest()
+
+
+def pack_images(names):
+    """Packs images into pages. Returns the pages as a (pages, PAGE_SIZE,
+       PAGE_SIZE, 4) RGBA array with the rows ordered bottom to top, and the
+       index as a dictionary of name: (page, x, y, width, height). Images
+       that do not fit on a page, or that can not be decoded, are left
+       out."""
+    images = []
+    for name in names:
+        try:
+            images.append((name, cache.decode_image(get_filename(name))))
+        except ImageDecodeException:
+            # Left to pyglet.resource, so only the scenes using the image
+            # fail when no decoder can read it.
+            pass
+    
+    # The allocator fills the pages best with the tallest images first.
+    images.sort(key=lambda (name, pixels): -pixels.shape[0])
+    
+    allocators = []
+    pages = []
+    index = {}
+    for name, pixels in images:
+        height, width = pixels.shape[:2]
+        
+        position = None
+        for page, allocator in enumerate(allocators):
+            try:
+                position = allocator.alloc(width + 2 * PADDING, height + 2 * PADDING)
+                break
+            except AllocatorException:
+                pass
+        
+        if position is None:
+            allocator = Allocator(PAGE_SIZE, PAGE_SIZE)
+            try:
+                position = allocator.alloc(width + 2 * PADDING, height + 2 * PADDING)
+            except AllocatorException:
+                # Too large for a page.
+                continue
+            allocators.append(allocator)
+            pages.append(numpy.zeros((PAGE_SIZE, PAGE_SIZE, 4), dtype=numpy.uint8))
+            page = len(pages) - 1
+        
+        x, y = position[0] + PADDING, position[1] + PADDING
+        pages[page][y:y + height, x:x + width] = pixels
+        index[name] = (page, x, y, width, height)
+    
+    if not pages:
+        return numpy.zeros((0, PAGE_SIZE, PAGE_SIZE, 4), dtype=numpy.uint8), index
+    return numpy.array(pages), index
+
+
+def remove_stale(key):
+    """Removes the pages and indices packed for older versions of the
+       images."""
+    for entry in os.listdir(cache.CACHE_FOLDER):
+        if entry.startswith('atlas-') and not entry.startswith('atlas-' + key):
+            try:
+                os.remove(os.path.join(cache.CACHE_FOLDER, entry))
+            except OSError:
+                pass
+
+
+def load_pages(names):
+    """Returns the pages and the index of a set of images, from the cache if
+       they were packed before."""
+    key = get_atlas_key(names)
+    pages_path = os.path.join(cache.CACHE_FOLDER, 'atlas-%s.npy' % key)
+    index_path = os.path.join(cache.CACHE_FOLDER, 'atlas-%s.json' % key)
+    
+    if os.path.exists(pages_path) and os.path.exists(index_path):
+        try:
+            f = open(index_path)
+            try:
+                index = json.load(f)
+            finally:
+                f.close()
+            return numpy.load(pages_path, mmap_mode='r'), index
+        except (IOError, ValueError):
+            # Corrupt entry; pack the images again below.
+            pass
+    
+    pages, index = pack_images(names)
+    
+    try:
+        # The index goes first: the pages are only looked for together
+        # with it.
+        if not os.path.isdir(cache.CACHE_FOLDER):
+            os.makedirs(cache.CACHE_FOLDER)
+        tmp_path = index_path + '.tmp'
+        f = open(tmp_path, 'w')
+        try:
+            json.dump(index, f)
+        finally:
+            f.close()
+        os.rename(tmp_path, index_path)
+        cache.save_array(pages_path, pages)
+        remove_stale(key)
+    except (IOError, OSError):
+        # The cache is an optimization only.
+        pass
+    
+    return pages, index
+
+
+class ImageAtlas(object):
+    """Hands out the images of the game as regions of the atlas pages."""
+    
+    def __init__(self):
+        self.textures = []
+        self.regions = {}
+    
+    def load(self):
+        """Packs or loads the pages and makes a texture for each. Needs a
+           window, and the resource path set up."""
+        pages, index = load_pages(get_image_names())
+        
+        self.textures = []
+        for page in pages:
+            height, width = page.shape[:2]
+            image_data = pyglet.image.ImageData(width, height, 'RGBA',
+                numpy.ascontiguousarray(page).tostring())
+            self.textures.append(image_data.get_texture())
+        
+        self.regions = {}
+        for name, (page, x, y, width, height) in index.items():
+            self.regions[str(name)] = self.textures[page].get_region(x, y, width, height)
+    
+    def image(self, name):
+        """Returns the image with the supplied resource name, like
+           pyglet.resource.image does. Images that are not in the atlas are
+           loaded by pyglet.resource."""
+        if name in self.regions:
+            return self.regions[name]
+        return pyglet.resource.image(name)
+
+# Singleton
+manager = ImageAtlas()
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of RCr and copyright (C) Maik Gosenshuis and 
+# Jeroen Tietema 2008-09.
+#
+# RCr is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RCr is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RCr.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Runs many headless races between car configurations to help balancing
+the parts. Every seed races all configurations once on every track of the
+cup; the seed decides the order on the starting grid and small offsets of
+the start positions.
+
+Run from the root directory of the game:
+
+    python batch.py -c fellali,basic,second_hand -c blue,monster,bridgestone \\
+        --seeds 0:1000 --csv balance.csv --json balance.json garden
+"""
+
+import math
+import random
+import time
+import multiprocessing
+from optparse import OptionParser
+
+import headless
+import cups
+import parts
+from simulation import SimulatedCar, RaceSimulation
+
+try:
+    import json
+except ImportError:
+    json = None
+
+
+# The maximum distance in pixels and the maximum rotation in degrees by
+# which the start positions are moved.
+START_JITTER = 10
+ROTATION_JITTER = 2
+
+# The maximum race time in seconds; cars that did not finish by then count
+# as not finished.
+TIME_LIMIT = 600
+
+# The surfaces loaded by a worker process, by (cup, track).
+_surfaces = {}
+
+
+def get_surface(cup, track):
+    """Returns the TrackSurface of a track, loading it once per process."""
+    if (cup, track) not in _surfaces:
+        _surfaces[(cup, track)] = headless.load_surface(cup, track)
+    return _surfaces[(cup, track)]
+
+
+def run_race((cup, track, seed, configurations, time_limit)):
+    """Runs a single race. Returns the track, the seed and a list with a
+       (configuration index, finished, total time, lap times) tuple per
+       car, ordered by finishing position."""
+    rng = random.Random('%s-%s-%d' % (cup, track, seed))
+    
+    order = range(len(configurations))
+    rng.shuffle(order)
+    
+    cars = [SimulatedCar(*configurations[index]) for index in order]
+    simulation = RaceSimulation(get_surface(cup, track), cars)
+    
+    for car in cars:
+        car.x += rng.uniform(-START_JITTER, START_JITTER)
+        car.y += rng.uniform(-START_JITTER, START_JITTER)
+        car.rotation += rng.uniform(-ROTATION_JITTER, ROTATION_JITTER)
+    simulation.fleet.gather()
+    
+    simulation.run(time_limit)
+    
+    results = []
+    for stats in simulation.results:
+        # Cars that did not finish in time only get an estimated total time.
+        finished = len(stats.lap_times) == simulation.surface.get_laps()
+        index = order[cars.index(stats.car)]
+        results.append((index, finished, stats.total_time, stats.lap_times))
+    
+    return track, seed, results
+
+
+def get_percentile(values, percentile):
+    """Returns a percentile of a sorted list, interpolating between the
+       nearest values."""
+    if not values:
+        return None
+    
+    position = (len(values) - 1) * percentile / 100.0
+    lower = int(math.floor(position))
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(values):
+    """Returns the count, mean, standard deviation and percentiles of a list
+       of numbers as a dictionary."""
+    values = sorted(values)
+    summary = {'count': len(values)}
+    if values:
+        mean = sum(values) / len(values)
+        summary['mean'] = mean
+        summary['std'] = math.sqrt(sum([(value - mean) ** 2 for value in values]) / len(values))
+        summary['min'] = values[0]
+        summary['max'] = values[-1]
+    for percentile in (5, 25, 50, 75, 95):
+        summary['p%d' % percentile] = get_percentile(values, percentile)
+    return summary
+
+
+class Tally(object):
+    """Collects the results of a single configuration."""
+    
+    def __init__(self, configuration):
+        self.configuration = configuration
+        self.name = '/'.join(configuration)
+        
+        self.races = 0
+        self.wins = 0
+        self.not_finished = 0
+        self.positions = []
+        self.total_times = []
+        self.lap_times = {}
+    
+    def add(self, track, position, finished, total_time, lap_times):
+        self.races += 1
+        self.positions.append(position)
+        if finished:
+            if position == 1:
+                self.wins += 1
+            self.total_times.append(total_time)
+        else:
+            self.not_finished += 1
+        self.lap_times.setdefault(track, []).extend(lap_times)
+    
+    def get_all_lap_times(self):
+        result = []
+        for lap_times in self.lap_times.values():
+            result.extend(lap_times)
+        return result
+    
+    def to_dict(self):
+        return {
+            'configuration': self.name,
+            'body': self.configuration[0],
+            'engine': self.configuration[1],
+            'tyres': self.configuration[2],
+            'races': self.races,
+            'wins': self.wins,
+            'win_rate': float(self.wins) / max(1, self.races),
+            'not_finished': self.not_finished,
+            'mean_position': float(sum(self.positions)) / max(1, len(self.positions)),
+            'race_time': summarize(self.total_times),
+            'lap_time': summarize(self.get_all_lap_times()),
+            'lap_time_by_track': dict([(track, summarize(lap_times))
+                for track, lap_times in self.lap_times.items()]),
+            'lap_times': self.lap_times,
+        }
+
+
+CSV_COLUMNS = ['configuration', 'races', 'wins', 'win_rate', 'not_finished', 'mean_position',
+    'lap_mean', 'lap_std', 'lap_p5', 'lap_p50', 'lap_p95', 'race_mean', 'race_p50']
+
+
+def write_csv(filename, tallies):
+    f = open(filename, 'w')
+    try:
+        f.write(','.join(CSV_COLUMNS) + '\n')
+        for tally in tallies:
+            data = tally.to_dict()
+            row = [data['configuration'], data['races'], data['wins'], data['win_rate'],
+                data['not_finished'], data['mean_position']]
+            for key in ('mean', 'std', 'p5', 'p50', 'p95'):
+                row.append(data['lap_time'].get(key))
+            for key in ('mean', 'p50'):
+                row.append(data['race_time'].get(key))
+            f.write(','.join([format_value(value) for value in row]) + '\n')
+    finally:
+        f.close()
+
+
+def format_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return '%.4f' % value
+    return str(value)
+
+
+def write_json(filename, tallies, info):
+    data = dict(info)
+    data['configurations'] = [tally.to_dict() for tally in tallies]
+    
+    f = open(filename, 'w')
+    try:
+        json.dump(data, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+
+
+def parse_seeds(text):
+    """Parses a seed range like 0:1000 (end exclusive), or a single number
+       of seeds like 1000."""
+    if ':' in text:
+        start, end = text.split(':', 1)
+        return range(int(start), int(end))
+    return range(int(text))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] cup')
+    parser.add_option('-c', '--car', action='append', dest='cars', default=[],
+        metavar='BODY,ENGINE,TYRES', help='add a car configuration (repeatable, at most 8)')
+    parser.add_option('-s', '--seeds', default='0:100', metavar='START:END',
+        help='range of seeds to race, end exclusive [default: %default]')
+    parser.add_option('-t', '--tracks', default=None, metavar='TRACK,...',
+        help='race only these tracks of the cup')
+    parser.add_option('-p', '--processes', type='int', default=None,
+        help='number of worker processes [default: number of cores]')
+    parser.add_option('--time-limit', type='float', default=TIME_LIMIT,
+        help='maximum race time in seconds [default: %default]')
+    parser.add_option('--csv', default=None, metavar='FILE', help='write a summary to FILE')
+    parser.add_option('--json', default=None, metavar='FILE',
+        help='write the distributions and all lap times to FILE')
+    options, args = parser.parse_args()
+    
+    if len(args) != 1:
+        parser.error('expected a cup')
+    if not cups.is_valid_cup(args[0]):
+        parser.error('unknown cup: %s' % args[0])
+    cup = cups.load(args[0])
+    
+    tracks = cup.track_names
+    if options.tracks:
+        tracks = options.tracks.split(',')
+        for track in tracks:
+            if track not in cup.track_names:
+                parser.error('unknown track: %s' % track)
+    
+    configurations = []
+    for car in options.cars:
+        configuration = tuple(car.split(','))
+        if len(configuration) != 3:
+            parser.error('expected BODY,ENGINE,TYRES: %s' % car)
+        for part_type, part_id in zip(('body', 'engine', 'tyres'), configuration):
+            if parts.manager.get_part_by_id(part_type, part_id) is None:
+                parser.error('unknown %s: %s' % (part_type, part_id))
+        if configuration in configurations:
+            parser.error('configuration given twice: %s' % car)
+        configurations.append(configuration)
+    
+    if not configurations:
+        parser.error('expected at least one car configuration')
+    if len(configurations) > 8:
+        parser.error('at most 8 cars fit on the starting grid')
+    if options.json and json is None:
+        parser.error('writing JSON needs Python 2.6 or later')
+    
+    seeds = parse_seeds(options.seeds)
+    tasks = [(cup.name, track, seed, configurations, options.time_limit)
+        for track in tracks for seed in seeds]
+    
+    tallies = [Tally(configuration) for configuration in configurations]
+    
+    start = time.time()
+    pool = multiprocessing.Pool(options.processes)
+    try:
+        done = 0
+        for track, seed, results in pool.imap_unordered(run_race, tasks, chunksize=4):
+            for position, (index, finished, total_time, lap_times) in enumerate(results):
+                tallies[index].add(track, position + 1, finished, total_time, lap_times)
+            
+            done += 1
+            if done % 100 == 0 or done == len(tasks):
+                print '%d/%d races (%.0fs)' % (done, len(tasks), time.time() - start)
+    finally:
+        pool.close()
+        pool.join()
+    
+    print
+    print '%-40s %6s %8s %8s %8s' % ('configuration', 'wins', 'win rate', 'lap p50', 'DNF')
+    for tally in tallies:
+        data = tally.to_dict()
+        print '%-40s %6d %7.1f%% %8s %8d' % (data['configuration'], data['wins'],
+            data['win_rate'] * 100, format_value(data['lap_time']['p50']), data['not_finished'])
+    
+    if options.csv:
+        write_csv(options.csv, tallies)
+    if options.json:
+        write_json(options.json, tallies, {
+            'cup': cup.name,
+            'tracks': tracks,
+            'seeds': [seeds[0], seeds[-1] + 1] if seeds else [],
+            'time_limit': options.time_limit,
+        })
+
+
+if __name__ == '__main__':
+    main()
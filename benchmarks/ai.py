@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of RCr and copyright (C) Maik Gosenshuis and 
+# Jeroen Tietema 2008-09.
+#
+# RCr is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RCr is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RCr.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the cost per tick of steering the computer drivers one by one
+with CarPhysics.follow_path and all at once with ComputerDrivers.
+
+Run from the root directory of the game:
+
+    python benchmarks/ai.py [cup track]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.getcwd())
+
+import headless
+import pyglet.resource
+from simulation import SimulatedCar, CarFleet, ComputerDrivers
+
+
+# Relative resource paths are looked up next to the script, which is not in
+# the root directory of the game.
+pyglet.resource.path = [os.path.abspath(path) for path in pyglet.resource.path]
+pyglet.resource.reindex()
+
+FIELD_SIZES = (3, 8, 32, 128)
+
+# Every measurement runs ticks for at least this many seconds.
+MIN_TIME = 0.5
+
+
+def place_cars(surface, num_cars):
+    """Returns cars at random positions on the track, heading roughly the
+       way the flow field points."""
+    width, height = surface.get_size()
+    cars = []
+    while len(cars) < num_cars:
+        x, y = random.uniform(0, width), random.uniform(0, height)
+        heading, distance = surface.get_flow_at((x, y))
+        if surface.get_friction_at((x, y)) == 0 or distance > 50:
+            continue
+        
+        car = SimulatedCar('fellali', 'basic', 'second_hand')
+        car.position = (x, y)
+        car.rotation = (heading + random.uniform(-60, 60)) % 360
+        car.speed = random.uniform(0, 400)
+        cars.append(car)
+    return cars
+
+
+def time_ticks(tick):
+    """Returns the average time a tick takes in seconds."""
+    ticks = 0
+    start = time.time()
+    while True:
+        tick()
+        ticks += 1
+        elapsed = time.time() - start
+        if elapsed >= MIN_TIME:
+            return elapsed / ticks
+
+
+def main(cup, track):
+    random.seed(0)
+    surface = headless.load_surface(cup, track)
+    
+    print '%6s %14s %14s %8s' % ('cars', 'follow_path', 'batched', 'speedup')
+    for num_cars in FIELD_SIZES:
+        cars = place_cars(surface, num_cars)
+        fleet = CarFleet(cars)
+        drivers = ComputerDrivers(fleet)
+        
+        def tick_scalar():
+            for car in cars:
+                car.follow_path(surface)
+        
+        def tick_batched():
+            drivers.control(surface)
+        
+        scalar_time = time_ticks(tick_scalar)
+        batched_time = time_ticks(tick_batched)
+        print '%6d %11.1f us %11.1f us %7.1fx' % (num_cars, scalar_time * 1e6,
+            batched_time * 1e6, scalar_time / batched_time)
+
+
+if __name__ == '__main__':
+    main(*(sys.argv[1:] or ['garden', 'garden1']))
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of RCr and copyright (C) Maik Gosenshuis and 
+# Jeroen Tietema 2008-09.
+#
+# RCr is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RCr is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RCr.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares Polygon.intersects with the oriented box tests in util.
+
+Run from the root directory of the game:
+
+    python benchmarks/collision.py
+"""
+
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.getcwd())
+
+import util
+
+
+# Roughly the size of a car on the track.
+HALF_WIDTH = 30
+HALF_HEIGHT = 45
+
+NUM_PAIRS = 20000
+NUM_BATCH = 1000
+
+
+def random_car():
+    return (random.uniform(0, 300), random.uniform(0, 300),
+        random.uniform(0, 2 * math.pi))
+
+
+def make_polygon((x, y, rotation)):
+    """Builds the outline of a car as a util.Polygon, the way the cars did
+       before they were tested as oriented boxes."""
+    cosa = math.cos(rotation)
+    sina = math.sin(rotation)
+    
+    center = util.Vector(x, y)
+    a = util.Vector(HALF_WIDTH * cosa - HALF_HEIGHT * sina, HALF_WIDTH * sina + HALF_HEIGHT * cosa)
+    b = util.Vector(-HALF_WIDTH * cosa - HALF_HEIGHT * sina, -HALF_WIDTH * sina + HALF_HEIGHT * cosa)
+    
+    return util.Polygon([center + a, center + b, center - a, center - b])
+
+
+def make_box((x, y, rotation)):
+    return util.OrientedBox(x, y, rotation, HALF_WIDTH, HALF_HEIGHT)
+
+
+def bench_polygons(pairs):
+    start = time.time()
+    hits = 0
+    for a, b in pairs:
+        if make_polygon(a).intersects(make_polygon(b)):
+            hits += 1
+    return time.time() - start, hits
+
+
+def bench_boxes(pairs):
+    start = time.time()
+    hits = 0
+    for a, b in pairs:
+        if util.obb_intersects(make_box(a), make_box(b)):
+            hits += 1
+    return time.time() - start, hits
+
+
+def bench_batch(cars):
+    boxes = util.boxes_to_array([make_box(car) for car in cars])
+    
+    start = time.time()
+    hits = 0
+    for car in cars:
+        hits += util.obb_intersects_many(make_box(car), boxes).sum()
+    return time.time() - start, hits
+
+
+def main():
+    random.seed(0)
+    pairs = [(random_car(), random_car()) for i in range(NUM_PAIRS)]
+    
+    polygon_time, polygon_hits = bench_polygons(pairs)
+    box_time, box_hits = bench_boxes(pairs)
+    assert polygon_hits == box_hits
+    
+    print '%d pairs, %d intersecting (shapes built per test)' % (NUM_PAIRS, box_hits)
+    print '  Polygon.intersects     %7.2f us/test' % (polygon_time / NUM_PAIRS * 1e6)
+    print '  obb_intersects         %7.2f us/test (%.1fx)' % (box_time / NUM_PAIRS * 1e6,
+        polygon_time / box_time)
+    
+    cars = [random_car() for i in range(NUM_BATCH)]
+    batch_time, batch_hits = bench_batch(cars)
+    tests = NUM_BATCH * NUM_BATCH
+    print '%d boxes against %d boxes' % (NUM_BATCH, NUM_BATCH)
+    print '  obb_intersects_many    %7.2f us/test' % (batch_time / tests * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of RCr and copyright (C) Maik Gosenshuis and 
+# Jeroen Tietema 2008-09.
+#
+# RCr is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RCr is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RCr.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures the cost of a step of a particle system like the dirt behind the
+cars at several numbers of particles, and of the dirt of a field of cars
+spread over a track with and without the level of detail of a ParticleBatch.
+
+Run from the root directory of the game:
+
+    python benchmarks/particles.py
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.getcwd())
+
+import numpy
+from cocos.director import director
+
+# The particle systems load their texture when cocos.particle is imported,
+# which needs an OpenGL context, and nodes need the size of the window.
+director.init(visible=False)
+
+from cocos.cocosnode import CocosNode
+from cocos.particle import ParticleSystem, ParticleBatch, Color
+from cocos.euclid import Point2
+
+from simulation import CAR_SCALE
+
+
+SYSTEM_SIZES = (75, 1000, 10000)
+
+FIELD_SIZES = (8, 32)
+
+# Roughly the size of a track, and of the part of it in view.
+TRACK_WIDTH, TRACK_HEIGHT = 4000, 3000
+VIEW_WIDTH, VIEW_HEIGHT = 1024, 768
+
+# The settings of the dirt behind the cars, see car.Dirt.
+DIRT = {
+    'duration': -1,
+    'gravity': Point2(0, 0),
+    'angle': -90,
+    'angle_var': 20,
+    'radial_accel': 200,
+    'radial_accel_var': 0,
+    'speed': 800,
+    'speed_var': 50,
+    'pos_var': Point2(0, 0),
+    'life': 0.3,
+    'life_var': 0.1,
+    'start_color': Color(0.5, 0.5, 0.5, 1.0),
+    'start_color_var': Color(0.5, 0.5, 0.5, 1.0),
+    'end_color': Color(0.1, 0.1, 0.1, 0.2),
+    'end_color_var': Color(0.1, 0.1, 0.1, 0.2),
+    'size': 10.0,
+    'size_var': 2.0,
+}
+
+DELTA = 1 / 60.0
+
+# The seconds of steps taken before measuring, so the system emits and
+# retires particles at a steady rate.
+WARM_UP = 1.0
+
+# Every measurement runs steps for at least this many seconds.
+MIN_TIME = 0.5
+
+
+def make_system(num_particles):
+    settings = dict(DIRT)
+    settings['total_particles'] = num_particles
+    settings['emission_rate'] = num_particles / settings['life']
+    return type('Dirt', (ParticleSystem,), settings)()
+
+
+def make_field(num_systems):
+    """Returns a ParticleBatch with cars at random positions on the track,
+       each with its own dirt."""
+    batch = ParticleBatch()
+    for i in range(num_systems):
+        car = CocosNode()
+        car.position = (random.uniform(0, TRACK_WIDTH), random.uniform(0, TRACK_HEIGHT))
+        car.rotation = random.uniform(0, 360)
+        car.scale = CAR_SCALE
+        car.add(make_system(75))
+        batch.add(car)
+    batch.on_enter()
+    return batch
+
+
+def time_steps(step):
+    """Returns the average time a step takes in seconds."""
+    for i in range(int(WARM_UP / DELTA)):
+        step()
+    
+    steps = 0
+    start = time.time()
+    while True:
+        step()
+        steps += 1
+        elapsed = time.time() - start
+        if elapsed >= MIN_TIME:
+            return elapsed / steps
+
+
+def main():
+    random.seed(0)
+    numpy.random.seed(0)
+    
+    print '%10s %14s %10s' % ('particles', 'step', 'alive')
+    for num_particles in SYSTEM_SIZES:
+        system = make_system(num_particles)
+        step_time = time_steps(lambda: system.step(DELTA))
+        alive = int((system.particle_life >= 0).sum())
+        print '%10d %11.1f us %10d' % (num_particles, step_time * 1e6, alive)
+    
+    print
+    print '%10s %14s %14s %8s' % ('systems', 'all', 'view', 'in view')
+    view_x = (TRACK_WIDTH - VIEW_WIDTH) / 2
+    view_y = (TRACK_HEIGHT - VIEW_HEIGHT) / 2
+    for num_systems in FIELD_SIZES:
+        batch = make_field(num_systems)
+        
+        def step_all():
+            for system in batch.systems:
+                system.step(DELTA)
+        
+        def step_view():
+            batch.set_view(view_x, view_y, VIEW_WIDTH, VIEW_HEIGHT)
+            step_all()
+        
+        all_time = time_steps(step_all)
+        view_time = time_steps(step_view)
+        in_view = len([system for system in batch.systems if not system.suspended])
+        print '%10d %11.1f us %11.1f us %8d' % (num_systems, all_time * 1e6, view_time * 1e6,
+            in_view)
+
+
+if __name__ == '__main__':
+    main()
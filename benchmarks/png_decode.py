@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of RCr and copyright (C) Maik Gosenshuis and 
+# Jeroen Tietema 2008-09.
+#
+# RCr is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RCr is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RCr.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the NumPy PNG decoder with the PyPNG reader on the track images.
+
+Run from the root directory of the game:
+
+    python benchmarks/png_decode.py [image.png ...]
+"""
+
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.getcwd())
+
+import numpy
+
+from pyglet.image.codecs import png
+from pyglet.image.codecs import pypng
+
+
+def time_call(function, *args):
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+def decode_fast(filename):
+    f = open(filename, 'rb')
+    try:
+        return png._decode_fast(f.read())
+    finally:
+        f.close()
+
+
+def decode_pypng(filename):
+    f = open(filename, 'rb')
+    try:
+        return pypng.Reader(file=f).read()
+    finally:
+        f.close()
+
+
+def main(filenames):
+    print '%-40s %10s %10s %8s' % ('image', 'numpy', 'pypng', 'speedup')
+    
+    for filename in filenames:
+        fast_time, fast = time_call(decode_fast, filename)
+        if fast is None:
+            print '%-40s not supported by the NumPy decoder' % filename
+            continue
+        
+        pypng_time, (width, height, pixels, metadata) = time_call(decode_pypng, filename)
+        
+        # Both decoders should produce the exact same pixels.
+        assert (numpy.frombuffer(fast[3], numpy.uint8) ==
+            numpy.frombuffer(pixels.tostring(), numpy.uint8)).all()
+        
+        print '%-40s %9.2fs %9.2fs %7.1fx' % (filename, fast_time, pypng_time,
+            pypng_time / max(fast_time, 1e-6))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or sorted(glob.glob(os.path.join('cups', 'garden', '*.png'))))
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of RCr and copyright (C) Maik Gosenshuis and 
+# Jeroen Tietema 2008-09.
+#
+# RCr is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RCr is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RCr.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import hashlib
+
+import numpy
+
+
+__all__ = ['load_image_array', 'load_derived_array', 'get_cache_path', 'CACHE_FOLDER']
+
+
+# Decoding the large track images is by far the slowest part of loading a
+# race, so the raw pixels are stored here as .npy files, which can be
+# memory-mapped on subsequent loads.
+CACHE_FOLDER = os.path.expanduser('~/.RCr_cache')
+
+
+def get_cache_key(filename):
+    """Returns a key identifying the current contents of a file. The key is
+       built from the size, the modification time and a hash of the
+       contents."""
+    stat = os.stat(filename)
+    
+    f = open(filename, 'rb')
+    try:
+        digest = hashlib.md5(f.read()).hexdigest()
+    finally:
+        f.close()
+    
+    return '%d-%d-%s' % (stat.st_size, int(stat.st_mtime), digest)
+
+
+def get_cache_name(filename, kind=None):
+    """Returns the name the cache files of a source file start with. Kind
+       tells different arrays derived from the same file apart. The name
+       holds a hash of the folder of the file, so files with the same name
+       in different cups do not share cache files."""
+    folder = os.path.dirname(os.path.abspath(filename))
+    name = '%s_%s' % (os.path.splitext(os.path.basename(filename))[0],
+        hashlib.md5(folder).hexdigest()[:8])
+    if kind is not None:
+        name = '%s.%s' % (name, kind)
+    return name
+
+
+def get_cache_path(filename, suffix='.npy', kind=None, depends=None):
+    """Returns the path of the cache file for the supplied source file.
+       Depends is a string describing anything else the cached array is
+       derived from; it becomes part of the key."""
+    key = get_cache_key(filename)
+    if depends is not None:
+        key = '%s-%s' % (key, hashlib.md5(depends).hexdigest())
+    return os.path.join(CACHE_FOLDER, '%s-%s%s' % (get_cache_name(filename, kind),
+        key, suffix))
+
+
+def remove_stale(filename, cache_path, kind=None):
+    """Removes cache files of older versions of the supplied source file."""
+    prefix = get_cache_name(filename, kind) + '-'
+    for entry in os.listdir(CACHE_FOLDER):
+        path = os.path.join(CACHE_FOLDER, entry)
+        if entry.startswith(prefix) and path != cache_path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def save_array(cache_path, array):
+    """Writes an array to the cache. The file is written under a temporary
+       name first, so an interrupted write never leaves a corrupt entry."""
+    if not os.path.isdir(CACHE_FOLDER):
+        os.makedirs(CACHE_FOLDER)
+    
+    tmp_path = cache_path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+        numpy.save(f, array)
+    finally:
+        f.close()
+    os.rename(tmp_path, cache_path)
+
+
+def decode_image(filename, decoder=None):
+    """Decodes an image into a (height, width, 4) RGBA array. The rows are
+       ordered bottom to top, like pyglet does."""
+    import pyglet.image
+    
+    image_data = pyglet.image.load(filename, decoder=decoder).get_image_data()
+    
+    # Keep the row order of the decoder and flip the rows with NumPy if
+    # needed; reordering them through pyglet is a lot slower.
+    pitch = image_data.width * 4
+    if image_data.pitch < 0:
+        pitch = -pitch
+    
+    data = image_data.get_data('RGBA', pitch)
+    pixels = numpy.frombuffer(data, dtype=numpy.uint8).reshape(
+        (image_data.height, image_data.width, 4))
+    if pitch < 0:
+        pixels = pixels[::-1]
+    return pixels
+
+
+def load_image_array(filename, decoder=None):
+    """Returns the pixels of an image as a read-only (height, width, 4) RGBA
+       array with the rows ordered bottom to top. The decoded pixels are
+       cached on disk and memory-mapped when the image is loaded again."""
+    cache_path = get_cache_path(filename)
+    
+    if os.path.exists(cache_path):
+        try:
+            return numpy.load(cache_path, mmap_mode='r')
+        except (IOError, ValueError):
+            # Corrupt entry; decode the image again below.
+            pass
+    
+    array = decode_image(filename, decoder)
+    
+    try:
+        save_array(cache_path, array)
+        remove_stale(filename, cache_path)
+    except (IOError, OSError):
+        # The cache is an optimization only; use the decoded pixels directly
+        # if it can not be written.
+        return array
+    
+    return numpy.load(cache_path, mmap_mode='r')
+
+
+def load_derived_array(filename, kind, compute, depends=None):
+    """Returns an array derived from a file, like the flow field derived
+       from a track overlay. The array is computed by calling compute() the
+       first time, and memory-mapped from the cache as long as neither the
+       file nor depends (see get_cache_path) change."""
+    cache_path = get_cache_path(filename, kind=kind, depends=depends)
+    
+    if os.path.exists(cache_path):
+        try:
+            return numpy.load(cache_path, mmap_mode='r')
+        except (IOError, ValueError):
+            pass
+    
+    array = compute()
+    
+    try:
+        save_array(cache_path, array)
+        remove_stale(filename, cache_path, kind)
+    except (IOError, OSError):
+        return array
+    
+    return numpy.load(cache_path, mmap_mode='r')
@@ -18,11 +18,12 @@
 
 # TODO: collision detection
 
-import math
 import os
 from random import randint
 import copy
 
+import numpy
+
 from cocos.draw import Line
 from cocos.cocosnode import CocosNode
 from cocos.sprite import Sprite
@@ -30,28 +31,16 @@ from cocos.director import director
 from pyglet.window import key
 import pyglet.resource
 import pyglet.media
-from cocos.particle import ParticleSystem, Color
+import pyglet.graphics
+from pyglet.sprite import SpriteGroup
+from pyglet.gl import glPushMatrix, glPopMatrix, GL_QUADS, GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA
+from cocos.particle import ParticleSystem, ParticleBatch, Color, multiply_transforms
 from cocos.euclid import Point2
 
 import parts
-from util import signum
+import atlas
 from game_state import state
-import util
-
-# Convenience constants.
-FORWARD = RIGHT = 1
-REVERSE = LEFT = -1
-STILL = 0
-
-# Multipliers used to increase the effect of acceleration.
-ACCEL_MULTIPLIERS = {
-    FORWARD:    2000,
-    STILL:      0,
-    REVERSE:    1000 
-}
-
-# The speed at which the car can rotate.
-ROTATION_SPEED = 150
+from simulation import CarPhysics, CAR_SCALE, FORWARD, RIGHT, REVERSE, LEFT, STILL
 
 # Friction constants for different terrain types. These influence the
 # maximum speed, the acceleration time and the brake time of the car.
@@ -64,6 +53,9 @@ TYRE_NAMES = ['tyre_fl','tyre_fr','tyre_bl','tyre_br']
 
 MAX_TYRE_ROTATION = 30
 
+# The opacity of ghost cars.
+GHOST_OPACITY = 100
+
 COMPUTER_NAMES = [
     'Brutus',
     'Rufus',
@@ -77,7 +69,7 @@ COMPUTER_NAMES = [
 ENGINE_SOUND = pyglet.media.load(os.path.join('sound', 'engine.wav'), streaming=False)
 
 
-class Car(CocosNode):
+class Car(CarPhysics, CocosNode):
     @classmethod
     def get_default(cls):
         """Returns an instance of Car with default configuration."""
@@ -146,18 +138,7 @@ class Car(CocosNode):
     def reset(self, rotation=0):
         """Resets some properties of the car, such as rotation and speed.
            This is useful when switching races."""
-        self.scale = 0.3
-           
-        self.speed = 0
-        self.rotation = rotation
-        
-        self.stopping = False
-        
-        # The direction in which we are accelerating.
-        self.accel_dir = 0
-        
-        # The direction in which we are rotating.
-        self.rot_dir = 0
+        CarPhysics.reset(self, rotation)
         
         # The current track the car is racing at. This reference is required
         # to request some additional information during races.
@@ -169,30 +150,9 @@ class Car(CocosNode):
         self.engine_sound.pitch = 0.7
         self.engine_sound.volume = 0.1
     
-    def set_part_dependant_properties(self):
-        """Sets properties that depend on the car's parts. These mainly
-           relate to physical properties."""
-        self.friction_multiplier = (1.0/self.mass) * self.grip
-        
-        # Multiplier used in calculation of maximum speed and acceleration.
-        self.accel_multiplier = self.friction_multiplier * self.power
-        
-        # Braking depends on the friction, as well as the mass of the car.
-        self.brake_multiplier = self.friction_multiplier * (10 - self.mass)
-        
-        # recalculate the size
-        body = self.get('body')
-        self.width = body.width
-        self.height = body.height
-        
-    def update(self, dt):
-        """Update the car's state."""
-        friction = self.track.get_friction_at(self.position)
-        self.speed = self.calculate_speed(dt, friction)
-        
-        rot_factor = min(1, abs(self.speed) / 200)
-        self.rotation = (self.rotation + (rot_factor * ROTATION_SPEED * self.rot_dir * signum(self.speed) * dt)) % 360
-        
+    def update_effects(self):
+        """Updates the tyres, the dirt and the engine sound to the state of
+           the car after a step of the race simulation."""
         tyre_rotation = MAX_TYRE_ROTATION * self.rot_dir
         for tyre in self.front_tyres:
             tyre.rotation = tyre_rotation
@@ -203,87 +163,6 @@ class Car(CocosNode):
         # Make the engine sound pitch relative to the speed.
         self.engine_sound.pitch = 0.7 + min(abs(self.speed) / 1000 * 0.7, 0.7)
         self.engine_sound.volume = 0.1 + min(abs(self.speed) / 1000 * 0.2, 0.2)
-        
-        r = math.radians(self.rotation)
-        s = dt * self.speed
-        
-        target_x = self.x + math.sin(r) * s
-        target_y = self.y + math.cos(r) * s
-        
-        if self.is_valid_move((target_x, target_y)):
-            self.x = target_x
-            self.y = target_y
-    
-    def calculate_speed(self, dt, friction):
-        """Calculates the car's new speed based on its current speed, the
-           amount of time passed and physical properties like the friction
-           and the car's mass."""
-        
-        # Work with a copy of the speed, since we don't want to alter the
-        # state directly.
-        speed = self.speed
-        
-        accel_sig = signum(self.accel_dir)
-        speed_sig = signum(speed)
-        
-        if speed_sig == 0 and accel_sig == 0:
-            # Standing still and not accelerating.
-            return 0
-        elif accel_sig == speed_sig or speed_sig == 0:
-            # We are accelerating in the same direction as we are currently
-            # heading. Use a multiplier per direction, since we can accelerate
-            # forward more quickly than we can in reverse.
-            accel_multiplier = self.accel_multiplier * self.accel_dir * ACCEL_MULTIPLIERS[accel_sig]
-            
-            # The terrain friction will be used in the calculation.
-            speed_multiplier = accel_multiplier * (friction / 255.0)
-            
-            speed += speed_multiplier * dt
-            
-            # Cap the speed.
-            max_speed = speed_multiplier
-            if abs(speed) > abs(max_speed):
-                speed = max_speed
-        else:            
-            if accel_sig == 0:
-                # Let the friction slow down the car.
-                slow_down_multiplier = self.friction_multiplier
-            else:
-                # We want to apply brake power, but correct it with the amount
-                # of brake power applied by the player. Make sure it doesn't
-                # get below the friction multiplier; there is no brake that
-                # negatively influences physical friction.
-                slow_down_multiplier = max(self.friction_multiplier, self.brake_multiplier * abs(self.accel_dir))
-            
-            # We use a large constant in the calculation to increase the effect
-            # of slowing down.
-            speed -= speed_sig * slow_down_multiplier * 2000 * (friction / 255.0) * dt
-            
-            # Cap the speed.
-            if speed * speed_sig < 0:
-                speed = 0
-                
-                if self.stopping:
-                    self.accel_dir = 0
-        
-        return speed
-    
-    def is_valid_move(self, (target_x, target_y)):
-        if self.track.get_friction_at((target_x, target_y)) > 0:
-            return True
-        return False
-    
-    def disable_controls(self):
-        pass
-    
-    def stop(self):
-        self.disable_controls()
-        self.accel_dir = -1
-        self.stopping = True
-    
-    mass    = property(lambda self: self.body.mass)
-    power   = property(lambda self: self.engine.power)
-    grip    = property(lambda self: self.tyres.grip)
     
     def _add_engine(self, engine):
         self._engine = engine
@@ -306,7 +185,7 @@ class Car(CocosNode):
         self._tyres = tyres
         for tyre_name in TYRE_NAMES:
             # Note ...
-            self.add(Sprite(tyres.image), name=tyre_name, z=9)
+            self.add(Sprite(atlas.manager.image(tyres.image)), name=tyre_name, z=9)
     def _set_tyres(self, tyres_name):
         for tyre_name in TYRE_NAMES:
             self.try_remove(tyre_name)
@@ -363,39 +242,6 @@ class Car(CocosNode):
         except Exception:
             pass
     
-    def get_polygon(self):
-#        float cosa = (float)Math.cos((double)ang), sina = (float)Math.sin((double)ang);
-#  
-#  Vector2D A = new Vector2D(S.x * cosa - S.y * sina, S.x * sina + S.y * cosa);
-#  Vector2D B = new Vector2D(-S.x * cosa - S.y * sina, -S.x * sina + S.y * cosa);
-        # center point
-        C = util.Vector(self.x, self.y)
-        
-        rad = math.radians(self.rotation)
-        
-        cosa = math.cos(rad)
-        sina = math.sin(rad)
-        
-        h = self.height * self.scale / 2
-        w = self.width * self.scale / 2
-        
-        # offset
-        A = util.Vector(w * cosa - h * sina, w * sina + h * cosa) 
-        # y offset
-        B = util.Vector(-w * cosa - h * sina, -w * sina + h * cosa)
-        
-#  polygon.moveTo(C.x + A.x, C.y + A.y);
-#  polygon.lineTo(C.x + B.x, C.y + B.y);
-#  polygon.lineTo(C.x - A.x, C.y - A.y);
-#  polygon.lineTo(C.x - B.x, C.y - B.y);
-        
-        upper_left  = util.Vector(C.x + A.x, C.y + A.y)
-        upper_right = util.Vector(C.x + B.x, C.y + B.y)
-        lower_right = util.Vector(C.x - A.x, C.y - A.y)
-        lower_left  = util.Vector(C.x - B.x, C.y - B.y)
-        
-        return util.Polygon([upper_left, upper_right, lower_right, lower_left])
-    
 
 class PlayerCar(Car):
     def __init__(self, *args, **kwargs):
@@ -412,55 +258,174 @@ class PlayerCar(Car):
     def disable_controls(self):
         self.controls_enabled = False
         
-    def update(self, dt):
+    def control(self, simulation):
         if self.controls_enabled:
             self.rot_dir = self.keyboard[key.RIGHT] - self.keyboard[key.LEFT]
             self.accel_dir = self.keyboard[key.UP] - self.keyboard[key.DOWN]
-        
-        Car.update(self, dt)
     
     name = property(lambda self: state.profile.name)
 
 
 class ComputerCar(Car):
+    driven_by_computer = True
+    
     def __init__(self, *args, **kwargs):
         Car.__init__(self, *args, **kwargs)
         
         # TODO: prevent a name to be taken twice.
         self.name = COMPUTER_NAMES[randint(0, len(COMPUTER_NAMES) - 1)]
     
-    def update(self, dt):
+    def control(self, simulation):
         if not self.stopping:
-            rotation_left = (self.rotation - 45) % 360
-            rotation_right = (self.rotation + 45) % 360
-        
-        
-            left_sensor = self.calc_sensor_pos(rotation_left)
-            right_sensor = self.calc_sensor_pos(rotation_right)
-            center_sensor = self.calc_sensor_pos(self.rotation)
+            self.follow_path(simulation.surface)
         
-            left_friction = self.track.get_path_at(left_sensor)
-            right_friction = self.track.get_path_at(right_sensor)
-            center_friction = self.track.get_path_at(center_sensor)
-        
-            if (left_friction > right_friction and left_friction > center_friction):
-                self.rot_dir = -1
-            elif (left_friction < right_friction and center_friction < right_friction):
-                self.rot_dir = 1
-            else:
-                self.rot_dir = 0
+
+class GhostCar(CocosNode):
+    """A translucent car without physics, showing where a recorded lap
+       was at the same time. It does not collide with the other cars."""
+    
+    def __init__(self, body, tyres):
+        CocosNode.__init__(self)
         
-            self.accel_dir = 1
+        self.scale = CAR_SCALE
         
-        Car.update(self, dt)
+        # The sprites of the parts are shared by the cars, so the ghost gets
+        # its own to make them translucent.
+        self.add(Sprite(atlas.manager.image(body.image), opacity=GHOST_OPACITY), z=10)
+        for tyre_name in TYRE_NAMES:
+            fb = tyre_name[-2]
+            x = getattr(body, 'tyres_' + fb + 'x_offset')
+            y = getattr(body, 'tyres_' + fb + 'y_offset')
+            if tyre_name[-1] == 'l':
+                x *= -1
+            self.add(Sprite(atlas.manager.image(tyres.image), position=(x, y), opacity=GHOST_OPACITY), z=9)
+
+
+class CarBatch(ParticleBatch):
+    """Draws the cars added to it with one draw call per texture for the
+       whole field, instead of a few for every part of every car.
+       
+       The sprites of the parts live in a single pyglet Batch, with a vertex
+       list for every z order and texture. The corners of the sprites are
+       computed from the car transforms on the CPU every frame, since the
+       parts share their sprites between cars. The dirt is drawn as by a
+       ParticleBatch, below the cars. Other nodes in the cars are not drawn."""
     
-    def calc_sensor_pos(self, rotation):
-        r = math.radians(rotation)
+    def __init__(self):
+        ParticleBatch.__init__(self)
         
-        target_x = self.x + math.sin(r) * (self.height/2 +10)
-        target_y = self.y + math.cos(r) * (self.height/2 +10)
-        return (target_x, target_y)
+        self.batch = pyglet.graphics.Batch()
+        self.ordered_groups = {}
         
+        # The vertex lists of the sprites, with the sprites they hold, and
+        # the (z, texture) of every sprite they were made for.
+        self.vertex_lists = []
+        self.layout = None
+    
+    def get_sprites(self):
+        """Returns the (car, z, sprite) tuples of the sprites of the cars,
+           ordered by z and texture."""
+        sprites = []
+        for car_z, car in self.children:
+            for z, child in car.children:
+                if isinstance(child, Sprite):
+                    sprites.append((z, child._texture.id, car, child))
+        sprites.sort(key=lambda sprite: sprite[:2])
+        return [(car, z, sprite) for z, texture_id, car, sprite in sprites]
+    
+    def get_ordered_group(self, z):
+        if z not in self.ordered_groups:
+            self.ordered_groups[z] = pyglet.graphics.OrderedGroup(z)
+        return self.ordered_groups[z]
+    
+    def make_vertex_lists(self, sprites):
+        """Makes a vertex list for every run of sprites with the same z order
+           and texture."""
+        for vertex_list, run in self.vertex_lists:
+            vertex_list.delete()
+        self.vertex_lists = []
+        
+        runs = []
+        for car, z, sprite in sprites:
+            if runs and runs[-1][0] == (z, sprite._texture.id):
+                runs[-1][1].append((car, sprite))
+            else:
+                runs.append(((z, sprite._texture.id), [(car, sprite)]))
+        
+        for (z, texture_id), run in runs:
+            texture = run[0][1]._texture
+            group = SpriteGroup(texture, GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA,
+                self.get_ordered_group(z))
+            tex_coords = []
+            for car, sprite in run:
+                tex_coords.extend(sprite._texture.tex_coords)
+            vertex_list = self.batch.add(4 * len(run), GL_QUADS, group,
+                'v2f/stream', 'c4B/stream', ('t3f', tex_coords))
+            self.vertex_lists.append((vertex_list, run))
+    
+    def update_vertices(self):
+        """Moves the corners of the sprites to where the cars put them."""
+        sprites = self.get_sprites()
+        layout = [(z, sprite._texture) for car, z, sprite in sprites]
+        if layout != self.layout:
+            self.make_vertex_lists(sprites)
+            self.layout = layout
+        if not sprites:
+            return
+        
+        car_transforms = {}
+        for car_z, car in self.children:
+            car_transforms[car] = self.get_node_transform(car)
+        
+        rows = []
+        colors = []
+        for car, z, sprite in sprites:
+            image = sprite._texture
+            rows.append(car_transforms[car] + (sprite.rotation, sprite.scale) +
+                tuple(sprite.position) + (image.anchor_x, image.anchor_y,
+                image.width, image.height, car.visible and sprite.visible))
+            colors.extend((tuple(sprite.color) + (int(sprite.opacity),)) * 4)
+        (a, b, c, d, tx, ty, rotation, scale, x, y, anchor_x, anchor_y, width, height,
+            visible) = numpy.array(rows).T
+        
+        # Sprites rotate and scale around the anchor of their image, which is
+        # at their position; the car transform comes on top of that.
+        r = numpy.radians(rotation)
+        cos = numpy.cos(r) * scale
+        sin = numpy.sin(r) * scale
+        sa, sb = a * cos - b * sin, a * sin + b * cos
+        sc, sd = c * cos - d * sin, c * sin + d * cos
+        stx, sty = a * x + b * y + tx, c * x + d * y + ty
+        
+        corners_x = numpy.array([-anchor_x, width - anchor_x, width - anchor_x, -anchor_x])
+        corners_y = numpy.array([-anchor_y, -anchor_y, height - anchor_y, height - anchor_y])
+        
+        # Hidden sprites collapse to a point.
+        vertices = numpy.empty((len(sprites), 4, 2))
+        vertices[:,:,0] = ((sa * corners_x + sb * corners_y + stx) * visible).T
+        vertices[:,:,1] = ((sc * corners_x + sd * corners_y + sty) * visible).T
+        vertices = vertices.reshape(-1).tolist()
+        
+        first = 0
+        for vertex_list, run in self.vertex_lists:
+            last = first + len(run)
+            vertex_list.vertices[:] = vertices[first * 8:last * 8]
+            vertex_list.colors[:] = colors[first * 16:last * 16]
+            first = last
+    
+    def visit(self):
+        if not self.visible:
+            return
+        
+        # The dirt, below the cars.
+        self.draw()
+        
+        self.update_vertices()
+        glPushMatrix()
+        self.transform()
+        self.batch.draw()
+        glPopMatrix()
+
 
 class Dirt(ParticleSystem):
     # total particles
@@ -130,6 +130,16 @@ class ParticleSystem( CocosNode ):
     #:color modulate
     color_modulate = True
 
+    #: Level of detail: the fraction of the emission rate that is emitted
+    detail = 1.0
+
+    #: Whether the simulation and drawing are suspended, e.g. while the
+    #: system is out of view
+    suspended = False
+
+    #: Seconds that passed while the system was suspended
+    suspended_time = 0.0
+
     def __init__(self):
         super(ParticleSystem,self).__init__()
 
@@ -154,6 +164,12 @@ class ParticleSystem( CocosNode ):
         # size x 1
         self.particle_size = numpy.zeros( (self.total_particles, 1), numpy.float32 )
 
+        #: Stack of the indices of the dead particles. The first
+        #: free_count entries are valid; the top is at the end, and the
+        #: lowest indices are emitted first.
+        self.free_slots = numpy.arange( self.total_particles - 1, -1, -1 )
+        self.free_count = self.total_particles
+
         #: How many particles can be emitted per second
         self.emit_counter = 0
         
@@ -162,11 +178,29 @@ class ParticleSystem( CocosNode ):
 
         self.schedule( self.step )
 
+    #: The ParticleBatch that draws the particles, if the system is below one
+    batch = None
+
     def on_enter( self ):
         super( ParticleSystem, self).on_enter()
         self.add_particle()
 
+        self.batch = self.get_ancestor( ParticleBatch )
+        if self.batch is not None:
+            self.batch.add_system( self )
+
+    def on_exit( self ):
+        super( ParticleSystem, self).on_exit()
+
+        if self.batch is not None:
+            self.batch.remove_system( self )
+            self.batch = None
+
     def draw( self ):
+        if self.batch is not None or self.suspended:
+            # drawn by the batch, or not at all
+            return
+
         glPushMatrix()
         self.transform()
 
@@ -221,18 +255,21 @@ class ParticleSystem( CocosNode ):
 
 
     def step( self, delta ):
+        if self.suspended:
+            self.suspended_time += delta
+            return
+
         if self.active:
-            rate = 1.0 / self.emission_rate
+            rate = 1.0 / (self.emission_rate * self.detail)
             self.emit_counter += delta
 
 #            if random.random() < 0.01:
 #                delta += 0.5
 
-            self.particle_count = sum( self.particle_life >= 0 )
-
-            while self.particle_count < self.total_particles and self.emit_counter > rate:
-                self.add_particle()
-                self.emit_counter -= rate
+            count = min( int( self.emit_counter / rate ), self.free_count )
+            if count > 0:
+                self.add_particles( count )
+                self.emit_counter -= count * rate
 
             self.elapsed += delta
 
@@ -242,8 +279,66 @@ class ParticleSystem( CocosNode ):
         self.update_particles( delta )
 
     def add_particle( self ):
-        self.init_particle()
-        self.particle_count += 1
+        self.add_particles( 1 )
+
+    def add_particles( self, count ):
+        '''Emits count particles at once, taking their slots from the
+        top of the free stack'''
+        if count > self.free_count:
+            raise Exception("No empty particle")
+
+        self.free_count -= count
+        idxs = self.free_slots[self.free_count:self.free_count + count]
+        self.init_particles( idxs )
+
+        # particles can be born dead when the life variance is larger than
+        # the life; they go straight back on the stack
+        stillborn = idxs[self.particle_life[idxs,0] < 0]
+        if len(stillborn):
+            self.free_slots[self.free_count:self.free_count + len(stillborn)] = stillborn
+            self.free_count += len(stillborn)
+
+        self.particle_count = self.total_particles - self.free_count
+
+    def suspend( self ):
+        '''Stops simulating and drawing the particles until resume()'''
+        self.suspended = True
+
+    def resume( self ):
+        '''Catches up with the time the system was suspended in a single
+        step, and continues simulating and drawing the particles'''
+        self.suspended = False
+        if self.suspended_time > 0:
+            self.fast_forward( self.suspended_time )
+            self.suspended_time = 0.0
+
+    def fast_forward( self, delta ):
+        '''Advances the particles by delta seconds at once, without
+        emitting. When delta is longer than the particles live, they are
+        all simply retired.'''
+        if delta > self.life + self.life_var:
+            self.particle_life.fill( -1.0 )
+            self.particle_color[:,3] = 0
+            self.free_slots[:] = numpy.arange( self.total_particles - 1, -1, -1 )
+            self.free_count = self.total_particles
+            self.particle_count = 0
+        else:
+            self.update_particles( delta )
+
+        if self.active:
+            self.elapsed += delta
+            if self.duration != -1 and self.duration < self.elapsed:
+                self.stop_system()
+
+    def get_reach( self ):
+        '''Returns how far the particles can get from the emitter, roughly'''
+        life = self.life + self.life_var
+        speed = abs( self.speed ) + self.speed_var
+        accel = abs( self.radial_accel ) + self.radial_accel_var + \
+                abs( self.tangential_accel ) + self.tangential_accel_var + \
+                abs( self.gravity )
+        return max( abs( self.pos_var.x ), abs( self.pos_var.y ) ) + \
+               speed * life + accel * life * life / 2
 
     def stop_system( self ):
         self.active = False
@@ -258,7 +353,7 @@ class ParticleSystem( CocosNode ):
         # radial: posx + posy
         norm = numpy.sqrt( self.particle_pos[:,0] ** 2 + self.particle_pos[:,1] ** 2 )
         # XXX prevent div by 0
-        norm = numpy.select( [norm==0], [0.0000001], default=norm )
+        norm[norm == 0] = 0.0000001
         posx = self.particle_pos[:,0] / norm
         posy = self.particle_pos[:,1] / norm
 
@@ -277,88 +372,245 @@ class ParticleSystem( CocosNode ):
         self.particle_pos += self.particle_dir * delta
 
         # life
+        alive = self.particle_life[:,0] >= 0
         self.particle_life -= delta
+        dead = self.particle_life[:,0] < 0
 
+        # push the particles that died in this step on the free stack
+        died = (alive & dead).nonzero()[0]
+        if len(died):
+            self.free_slots[self.free_count:self.free_count + len(died)] = died
+            self.free_count += len(died)
+            self.particle_count = self.total_particles - self.free_count
 
         # color
         self.particle_color += self.particle_delta_color * delta
 
         # if life < 0, set alpha in 0
-        self.particle_color[:,3] = numpy.select( [self.particle_life[:,0] < 0], [0], default=self.particle_color[:,3] )
+        self.particle_color[dead, 3] = 0
 
 #        print self.particles[0]
 #        print self.pas[0,0:4]
 
-    def init_particle( self ):
-        # position
-#        p=self.particles[idx]
-
-        a = self.particle_life < 0
-        idxs = a.nonzero()
-
-        idx = -1
-
-        if len(idxs[0]) > 0:
-            idx = idxs[0][0] 
-        else:
-            raise Exception("No empty particle")
+    def init_particles( self, idxs ):
+        '''Initializes the particles at the indices idxs, all at once'''
+        count = len( idxs )
+        rands = lambda *shape: numpy.random.uniform( -1, 1, (count,) + shape )
 
         # position
-        self.particle_pos[idx][0] = self.pos_var.x * rand()
-        self.particle_pos[idx][1] = self.pos_var.y * rand()
+        self.particle_pos[idxs,0] = self.pos_var.x * rands()
+        self.particle_pos[idxs,1] = self.pos_var.y * rands()
 
-
-        a = math.radians( self.angle + self.angle_var * rand() )
-        v = Point2( math.cos( a ), math.sin( a ) )
-        s = self.speed + self.speed_var * rand()
-
-        dir = v * s
+        a = numpy.radians( self.angle + self.angle_var * rands() )
+        s = self.speed + self.speed_var * rands()
 
         # direction
-        self.particle_dir[idx][0] = dir.x
-        self.particle_dir[idx][1] = dir.y
+        self.particle_dir[idxs,0] = numpy.cos( a ) * s
+        self.particle_dir[idxs,1] = numpy.sin( a ) * s
 
         # radial accel
-        self.particle_rad[idx] = self.radial_accel + self.radial_accel_var * rand()
-
+        self.particle_rad[idxs,0] = self.radial_accel + self.radial_accel_var * rands()
 
         # tangential accel
-        self.particle_tan[idx] = self.tangential_accel + self.tangential_accel_var * rand()
+        self.particle_tan[idxs,0] = self.tangential_accel + self.tangential_accel_var * rands()
         
         # life
-        life = self.particle_life[idx] = self.life + self.life_var * rand()
+        life = self.life + self.life_var * rands( 1 )
+        self.particle_life[idxs] = life
 
         # Color
         # start
-        sr = self.start_color.r + self.start_color_var.r * rand()
-        sg = self.start_color.g + self.start_color_var.g * rand()
-        sb = self.start_color.b + self.start_color_var.b * rand()
-        sa = self.start_color.a + self.start_color_var.a * rand()
-
-        self.particle_color[idx][0] = sr
-        self.particle_color[idx][1] = sg
-        self.particle_color[idx][2] = sb
-        self.particle_color[idx][3] = sa
+        start = numpy.array( self.start_color.to_array() ) + \
+            numpy.array( self.start_color_var.to_array() ) * rands( 4 )
+        self.particle_color[idxs] = start
 
         # end
-        er = self.end_color.r + self.end_color_var.r * rand()
-        eg = self.end_color.g + self.end_color_var.g * rand()
-        eb = self.end_color.b + self.end_color_var.b * rand()
-        ea = self.end_color.a + self.end_color_var.a * rand()
-
-        delta_color_r = (er - sr) / life
-        delta_color_g = (eg - sg) / life
-        delta_color_b = (eb - sb) / life
-        delta_color_a = (ea - sa) / life
-
-        self.particle_delta_color[idx][0] = delta_color_r
-        self.particle_delta_color[idx][1] = delta_color_g
-        self.particle_delta_color[idx][2] = delta_color_b
-        self.particle_delta_color[idx][3] = delta_color_a
+        end = numpy.array( self.end_color.to_array() ) + \
+            numpy.array( self.end_color_var.to_array() ) * rands( 4 )
+        self.particle_delta_color[idxs] = (end - start) / life
 
         # size
-        self.particle_size[idx] = self.size + self.size_var * rand()
+        self.particle_size[idxs,0] = self.size + self.size_var * rands()
 
         # gravity
-        self.particle_grav[idx][0] = self.gravity.x
-        self.particle_grav[idx][1] = self.gravity.y
+        self.particle_grav[idxs,0] = self.gravity.x
+        self.particle_grav[idxs,1] = self.gravity.y
+
+
+def multiply_transforms( outer, inner ):
+    '''Returns the transformation that applies inner first and outer
+    second, for transformations like ParticleBatch.get_node_transform
+    returns'''
+    a, b, c, d, tx, ty = inner
+    na, nb, nc, nd, ntx, nty = outer
+    return (na * a + nb * c, na * b + nb * d,
+            nc * a + nd * c, nc * b + nd * d,
+            na * tx + nb * ty + ntx, nc * tx + nd * ty + nty)
+
+
+class ParticleBatch( CocosNode ):
+    '''Draws the particles of all the particle systems below it at once,
+    before its children. The systems that share a texture, a blend mode and
+    a point size are drawn with a single glDrawArrays call: the particles
+    are transformed to the coordinates of the batch on the CPU, and copied
+    into one interleaved array of positions and colors that is reused every
+    frame. Like ParticleSystem.draw, the dead particles are copied as well;
+    they are transparent.'''
+
+    #: The lowest level of detail, at the corners of the view
+    min_detail = 0.25
+
+    def __init__( self ):
+        super( ParticleBatch, self ).__init__()
+
+        #: The systems below the batch, in the order they entered the stage
+        self.systems = []
+
+        # x, y, r, g, b, a per particle
+        self.vertices = numpy.zeros( (0, 6), numpy.float32 )
+
+    def add_system( self, system ):
+        if system not in self.systems:
+            self.systems.append( system )
+
+    def remove_system( self, system ):
+        if system in self.systems:
+            self.systems.remove( system )
+
+    def set_view( self, x, y, width, height ):
+        '''Sets the level of detail of the systems for a view rectangle in
+        the coordinates of the batch. Systems whose particles can not reach
+        the view are suspended. The others emit fewer particles the farther
+        they are from the center of the view, down to min_detail of their
+        emission rate at the corners.'''
+        center_x = x + width / 2.0
+        center_y = y + height / 2.0
+        radius = max( math.hypot( width, height ) / 2.0, 1.0 )
+
+        for system in self.systems:
+            a, b, c, d, tx, ty = self.get_node_transform( system )
+            reach = system.get_reach() * math.hypot( a, c )
+            in_view = (x - reach <= tx <= x + width + reach and
+                       y - reach <= ty <= y + height + reach)
+
+            if not in_view:
+                if not system.suspended:
+                    system.suspend()
+                continue
+
+            if system.suspended:
+                system.resume()
+
+            distance = math.hypot( tx - center_x, ty - center_y )
+            system.detail = max( self.min_detail,
+                                 1.0 - (1.0 - self.min_detail) * distance / radius )
+
+    def get_node_transform( self, node ):
+        '''Returns the transformation from the coordinates of a node below
+        the batch to those of the batch as a tuple (a, b, c, d, tx, ty),
+        mapping x, y to a*x + b*y + tx, c*x + d*y + ty. It matches
+        CocosNode.transform of the node and its parents up to the batch.'''
+        transform = (1, 0, 0, 1, 0, 0)
+        while node is not self:
+            x, y = node.position
+            dx, dy = 0, 0
+            if node.transform_anchor != (0,0):
+                x += node.transform_anchor_x
+                y += node.transform_anchor_y
+                if node.transform_anchor != node.children_anchor:
+                    dx = node.children_anchor_x - node.transform_anchor_x
+                    dy = node.children_anchor_y - node.transform_anchor_y
+
+            r = math.radians( node.rotation )
+            cos = math.cos( r ) * node.scale
+            sin = math.sin( r ) * node.scale
+
+            # node = translate(x, y) * scale * rotate(-rotation) * translate(dx, dy)
+            local = (cos, sin, -sin, cos,
+                     cos * dx + sin * dy + x, -sin * dx + cos * dy + y)
+
+            # prepend the node to the transformation of its children
+            transform = multiply_transforms( local, transform )
+            node = node.parent
+        return transform
+
+    def fill_vertices( self ):
+        '''Copies the particles of the visible systems to the vertex
+        array, grouped by texture, blend mode and point size. Returns a
+        list of (system, first, count) tuples, one per group, with a system
+        of the group to take the drawing settings from.'''
+        groups = {}
+        keys = []
+        for system in self.systems:
+            if not system.visible or system.suspended or not system.particle_count:
+                continue
+            key = (system.texture.id, system.blend_additive, system.size)
+            if key not in groups:
+                groups[key] = []
+                keys.append( key )
+            groups[key].append( system )
+
+        needed = sum( [system.total_particles for system in self.systems] )
+        if needed > len( self.vertices ):
+            size = max( len( self.vertices ), 64 )
+            while size < needed:
+                size *= 2
+            self.vertices = numpy.zeros( (size, 6), numpy.float32 )
+
+        ranges = []
+        first = 0
+        for key in keys:
+            count = 0
+            for system in groups[key]:
+                a, b, c, d, tx, ty = self.get_node_transform( system )
+                n = first + count
+                m = n + system.total_particles
+                self.vertices[n:m,0:2] = numpy.dot( system.particle_pos, ((a, c), (b, d)) ) + (tx, ty)
+                self.vertices[n:m,2:6] = system.particle_color
+                count += system.total_particles
+            ranges.append( (groups[key][0], first, count) )
+            first += count
+        return ranges
+
+    def draw( self ):
+        ranges = self.fill_vertices()
+        if not ranges:
+            return
+
+        glPushMatrix()
+        self.transform()
+
+        glEnable(GL_TEXTURE_2D)
+        glEnable(GL_POINT_SPRITE)
+        glTexEnvi( GL_POINT_SPRITE, GL_COORD_REPLACE, GL_TRUE )
+
+        # one array, positions and colors interleaved
+        stride = 6 * 4
+        address = self.vertices.ctypes.data
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glVertexPointer(2, GL_FLOAT, stride, ctypes.cast( address, ctypes.POINTER(ctypes.c_float) ))
+        glEnableClientState(GL_COLOR_ARRAY)
+        glColorPointer(4, GL_FLOAT, stride, ctypes.cast( address + 2 * 4, ctypes.POINTER(ctypes.c_float) ))
+
+        glPushAttrib(GL_COLOR_BUFFER_BIT)
+        glEnable(GL_BLEND)
+
+        for system, first, count in ranges:
+            glPointSize( system.size )
+            glBindTexture(GL_TEXTURE_2D, system.texture.id )
+            if system.blend_additive:
+                glBlendFunc(GL_SRC_ALPHA, GL_ONE);
+            else:
+                glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA);
+            glDrawArrays(GL_POINTS, first, count)
+
+        # un -blend
+        glPopAttrib()
+
+        # disable states
+        glDisableClientState(GL_COLOR_ARRAY);
+        glDisableClientState(GL_VERTEX_ARRAY);
+        glDisable(GL_POINT_SPRITE);
+        glDisable(GL_TEXTURE_2D);
+
+        glPopMatrix()
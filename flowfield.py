@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of RCr and copyright (C) Maik Gosenshuis and 
+# Jeroen Tietema 2008-09.
+#
+# RCr is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RCr is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RCr.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Derives the flow field the computer drivers steer by from the path
+(red) channel of a track overlay.
+
+The field is computed on a grid of cells of FLOW_CELL x FLOW_CELL overlay
+pixels. Every cell holds the heading a car should drive at (in degrees,
+like the rotation of a car) and the distance to the centerline of the track
+(in track pixels).
+
+A breadth-first search along the track, starting at the line through the
+first position of the starting grid, measures the progress along the track.
+The cells where the path is strongest at every step of the progress form the
+centerline, a list of waypoints in racing order. The heading of a cell points
+at the waypoint LOOKAHEAD steps ahead of the cell, which makes cars follow
+the track and return to the centerline at the same time. Cells off the route
+around the track, like the grass, point back to it the shortest way.
+"""
+
+import math
+
+import numpy
+
+
+__all__ = ['compute_flow_field', 'FLOW_CELL', 'VERSION']
+
+
+# Changes when the way the field is computed changes, so fields cached by
+# older versions are computed again.
+VERSION = 1
+
+# The size of a cell of the flow field in overlay pixels.
+FLOW_CELL = 4
+
+# Cells with a path strength within this range of the strongest path across
+# the track form the centerline.
+CENTERLINE_TOLERANCE = 10
+
+# Cells are part of the route around the track when going around through
+# them takes at most this many cells more than the shortest way around.
+ROUTE_TOLERANCE = 40
+
+# The centerline only passes cells that take at most this many cells more
+# than the shortest way around.
+CENTERLINE_ROUTE = 16
+
+# The number of waypoints ahead of a cell its heading points at.
+LOOKAHEAD = 10
+
+# The number of points checked between a cell and a waypoint to see if
+# there is track all the way.
+SIGHT_SAMPLES = 8
+
+# The number of waypoints on each side over which the centerline is
+# averaged.
+SMOOTHING = 3
+
+NEIGHBOURS_4 = ((-1, 0), (1, 0), (0, -1), (0, 1))
+NEIGHBOURS_8 = NEIGHBOURS_4 + ((-1, -1), (-1, 1), (1, -1), (1, 1))
+
+
+def shift(array, (dy, dx), fill=0):
+    """Returns a copy of a 2D array moved by dy rows and dx columns; the
+       cells moved in are set to fill."""
+    result = numpy.empty_like(array)
+    result[...] = fill
+    height, width = array.shape
+    result[max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0)] = \
+        array[max(-dy, 0):height + min(-dy, 0), max(-dx, 0):width + min(-dx, 0)]
+    return result
+
+
+def grow_distance(seeds, passable, neighbours):
+    """Returns the number of steps from the nearest seed cell to every
+       passable cell, moving between neighbours only. Cells that can not be
+       reached are -1. The search grows all cells of the front at once."""
+    distance = numpy.where(seeds, 0, -1).astype(numpy.int32)
+    front = seeds.copy()
+    step = 0
+    while front.any():
+        step += 1
+        grown = numpy.zeros(front.shape, dtype=bool)
+        for offset in neighbours:
+            grown |= shift(front, offset, False)
+        front = grown & passable & (distance < 0)
+        distance[front] = step
+    return distance
+
+
+def get_start_line(track_cells, (start_x, start_y), rotation, cell_size, height):
+    """Returns the cells on the line through the start position across the
+       track, and the cells just in front of and behind it, as three
+       boolean grids."""
+    r = math.radians(rotation)
+    # Directions in (column, row) cells; rows run from the top of the track
+    # down, as in the overlay.
+    forward = (math.sin(r), -math.cos(r))
+    across = (math.cos(r), math.sin(r))
+    
+    column = start_x / cell_size
+    row = (height - start_y) / cell_size
+    
+    line = numpy.zeros(track_cells.shape, dtype=bool)
+    ahead = numpy.zeros(track_cells.shape, dtype=bool)
+    behind = numpy.zeros(track_cells.shape, dtype=bool)
+    rows, columns = track_cells.shape
+    for direction in (1, -1):
+        # Walk across the track in half cells, so the line has no gaps.
+        t = 0.0
+        while True:
+            c = int(column + across[0] * t * direction)
+            r = int(row + across[1] * t * direction)
+            if not (0 <= r < rows and 0 <= c < columns and track_cells[r, c]):
+                break
+            line[r, c] = True
+            
+            for side, cells in ((1, ahead), (-1, behind)):
+                c = int(column + across[0] * t * direction + forward[0] * side)
+                r = int(row + across[1] * t * direction + forward[1] * side)
+                if 0 <= r < rows and 0 <= c < columns:
+                    cells[r, c] = True
+            t += 0.5
+    
+    return line, ahead & track_cells & ~line, behind & track_cells & ~line
+
+
+def get_waypoints(progress, strength):
+    """Returns the (columns, rows) of the centerline at every step of the
+       progress along the track, averaged over SMOOTHING waypoints on each
+       side, and the steps they belong to. The centerline is made of the
+       cells where the path is strongest across the track."""
+    on_track = progress >= 0
+    steps = progress[on_track]
+    
+    strongest = numpy.zeros(steps.max() + 1)
+    numpy.maximum.at(strongest, steps, strength[on_track])
+    
+    rows, columns = numpy.indices(progress.shape)
+    on_line = on_track & (strength >= strongest[numpy.maximum(progress, 0)] - CENTERLINE_TOLERANCE)
+    steps = progress[on_line]
+    
+    count = numpy.bincount(steps)
+    steps = numpy.nonzero(count)[0]
+    waypoint_columns = numpy.bincount(progress[on_line], columns[on_line])[steps] / count[steps]
+    waypoint_rows = numpy.bincount(progress[on_line], rows[on_line])[steps] / count[steps]
+    
+    # The track is a loop, so average around the start line as well.
+    size = 2 * SMOOTHING + 1
+    kernel = numpy.ones(size) / size
+    smoothed = []
+    for waypoints in (waypoint_columns, waypoint_rows):
+        wrapped = numpy.concatenate((waypoints[-SMOOTHING:], waypoints, waypoints[:SMOOTHING]))
+        smoothed.append(numpy.convolve(wrapped, kernel, mode='valid'))
+    
+    return smoothed[0], smoothed[1], steps
+
+
+def fill_nearest(index):
+    """Sets the cells of an index grid that are -1 to the index of a nearby
+       cell, growing outwards from the cells that have one."""
+    while True:
+        missing = index < 0
+        if not missing.any():
+            return index
+        grown = index.copy()
+        for offset in NEIGHBOURS_8:
+            grown = numpy.where(grown < 0, shift(index, offset, -1), grown)
+        if (grown == index).all():
+            return index
+        index = grown
+
+
+def get_cells(plane):
+    """Returns a 2D plane of the overlay as a (rows, columns, FLOW_CELL x
+       FLOW_CELL) array of the pixels in every cell."""
+    height, width = plane.shape
+    rows, columns = height / FLOW_CELL, width / FLOW_CELL
+    cells = plane[:rows * FLOW_CELL, :columns * FLOW_CELL].reshape(
+        (rows, FLOW_CELL, columns, FLOW_CELL)).swapaxes(1, 2)
+    return cells.reshape((rows, columns, FLOW_CELL * FLOW_CELL)).astype(numpy.float32)
+
+
+def compute_flow_field(path_plane, friction_plane, start, overlay_scale):
+    """Returns the flow field of a track as a (rows, columns, 2) float32
+       array with the heading and the distance to the centerline of every
+       cell. Path_plane and friction_plane are the red and blue channels of
+       the overlay with the rows ordered top to bottom, start is the
+       ((x, y), rotation) of the first position of the starting grid.
+       Raises ValueError when the start is not on a closed loop around the
+       track."""
+    height = path_plane.shape[0]
+    cells = get_cells(path_plane)
+    rows, columns = cells.shape[:2]
+    strength = cells.mean(axis=2)
+    
+    track_cells = cells.max(axis=2) > 0
+    drivable = get_cells(friction_plane).min(axis=2) > 0
+    
+    cell_size = FLOW_CELL * overlay_scale
+    
+    # The progress along the track from the start line, and the remaining
+    # distance to it. The searches move to four neighbours only, so they
+    # can not slip through the line diagonally.
+    (start_position, rotation) = start
+    line, ahead, behind = get_start_line(track_cells, start_position, rotation, cell_size,
+        height * overlay_scale)
+    progress = grow_distance(ahead, track_cells & ~line, NEIGHBOURS_4)
+    remaining = grow_distance(behind, track_cells & ~line, NEIGHBOURS_4)
+    
+    # Only follow the shortest way around the track where parts of it run
+    # alongside each other, like a shortcut and the road around it.
+    lap = progress + remaining
+    route = (progress >= 0) & (remaining >= 0)
+    if not route.any():
+        raise ValueError('the start line is not on a closed loop around the track')
+    shortest = lap[route].min()
+    route &= lap <= shortest + ROUTE_TOLERANCE
+    progress[~route] = -1
+    
+    # Dead ends off the route are part of it up to half the tolerance deep,
+    # so the centerline only follows the cells close to the shortest way.
+    waypoint_columns, waypoint_rows, steps = get_waypoints(
+        numpy.where(lap <= shortest + CENTERLINE_ROUTE, progress, -1), strength)
+    num_waypoints = len(steps)
+    
+    # The waypoint of every cell; cells off the route take the waypoint of
+    # the nearest cell on the route.
+    index = numpy.where(route,
+        numpy.minimum(numpy.searchsorted(steps, progress), num_waypoints - 1), -1)
+    index = fill_nearest(index)
+    index[index < 0] = 0
+    
+    cell_rows, cell_columns = numpy.indices(index.shape)
+    
+    # Look as far ahead as possible, without looking through the walls of a
+    # tight corner.
+    lookahead = numpy.ones(index.shape, dtype=int)
+    for steps_ahead in range(2, LOOKAHEAD + 1):
+        waypoint = (index + steps_ahead) % num_waypoints
+        visible = numpy.ones(index.shape, dtype=bool)
+        for fraction in numpy.linspace(0, 1, SIGHT_SAMPLES):
+            sample_columns = cell_columns + (waypoint_columns[waypoint] - cell_columns) * fraction
+            sample_rows = cell_rows + (waypoint_rows[waypoint] - cell_rows) * fraction
+            visible &= track_cells[numpy.clip(sample_rows.astype(int), 0, rows - 1),
+                numpy.clip(sample_columns.astype(int), 0, columns - 1)]
+        lookahead[visible] = steps_ahead
+    
+    target = (index + lookahead) % num_waypoints
+    heading_x = waypoint_columns[target] - cell_columns
+    # Rows run down, y runs up.
+    heading_y = cell_rows - waypoint_rows[target]
+    
+    # The distance to the nearest waypoint around the waypoint of the cell.
+    distance = numpy.empty(index.shape)
+    distance[...] = numpy.inf
+    for offset in range(-LOOKAHEAD, LOOKAHEAD + 1):
+        waypoint = (index + offset) % num_waypoints
+        distance = numpy.minimum(distance, numpy.hypot(waypoint_columns[waypoint] - cell_columns,
+            waypoint_rows[waypoint] - cell_rows))
+    
+    # Cars off the route, on the grass or on a part of the track the route
+    # does not follow, drive back to the route the shortest way.
+    to_route = grow_distance(route, drivable | route, NEIGHBOURS_8)
+    unreachable = rows * columns
+    to_route[to_route < 0] = unreachable
+    closest = numpy.where(route, unreachable, to_route)
+    for offset_row, offset_column in NEIGHBOURS_8:
+        neighbour = shift(to_route, (-offset_row, -offset_column), unreachable)
+        closer = (neighbour < closest) & ~route
+        heading_x = numpy.where(closer, offset_column, heading_x)
+        heading_y = numpy.where(closer, -offset_row, heading_y)
+        closest = numpy.where(closer, neighbour, closest)
+    
+    field = numpy.empty((rows, columns, 2), dtype=numpy.float32)
+    field[:,:,0] = numpy.degrees(numpy.arctan2(heading_x, heading_y)) % 360
+    field[:,:,1] = distance * cell_size
+    return field
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of RCr and copyright (C) Maik Gosenshuis and 
+# Jeroen Tietema 2008-09.
+#
+# RCr is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RCr is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RCr.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Records the fastest lap of the player on every track, and plays it back
+as a ghost car.
+
+A ghost is a float32 array with the x, y and rotation of the car after every
+step of the lap, written with numpy.save to GHOST_FOLDER. Ghosts are
+memory-mapped while they are played back, so loading one costs nothing and
+only the samples the ghost reaches are ever read.
+"""
+
+import os
+import urllib
+
+import numpy
+
+
+__all__ = ['GhostRecorder', 'GhostPlayer', 'get_ghost_path', 'load_ghost',
+    'GHOST_FOLDER']
+
+
+GHOST_FOLDER = os.path.expanduser('~/.RCr_ghosts')
+
+# The number of samples the recording buffer starts with; it doubles when
+# it runs full.
+INITIAL_SAMPLES = 4096
+
+
+def get_ghost_path(profile_name, cup, track):
+    """Returns the path of the ghost of a player on a track."""
+    name = '-'.join([urllib.quote(part.encode('utf-8'), '')
+        for part in (unicode(profile_name), unicode(cup), unicode(track))])
+    return os.path.join(GHOST_FOLDER, name + '.npy')
+
+
+def load_ghost(filename):
+    """Returns the memory-mapped samples of a ghost, or None if there is no
+       usable ghost."""
+    if not os.path.exists(filename):
+        return None
+    
+    try:
+        samples = numpy.load(filename, mmap_mode='r')
+    except (IOError, ValueError):
+        return None
+    
+    if samples.ndim != 2 or samples.shape[1] != 3 or not len(samples):
+        return None
+    return samples
+
+
+class GhostRecorder(object):
+    """Samples a car after every step of a RaceSimulation and keeps its
+       fastest lap. Set it as the ghost_recorder of the simulation, which
+       then calls record() every step. Only laps faster than the supplied
+       best samples are kept."""
+    
+    def __init__(self, filename, car, best=None):
+        self.filename = filename
+        self.car = car
+        
+        # The number of steps of the fastest lap.
+        self.best_steps = None
+        if best is not None:
+            self.best_steps = len(best)
+        self.best_lap = None
+        
+        self.samples = numpy.empty((INITIAL_SAMPLES, 3), dtype=numpy.float32)
+        self.count = 0
+        
+        self.laps = 0
+        self.lap_start = 0
+    
+    def record(self, simulation):
+        stats = simulation.stats[self.car]
+        if stats.finished and len(stats.lap_times) == self.laps:
+            return
+        
+        if self.count == len(self.samples):
+            samples = numpy.empty((len(self.samples) * 2, 3), dtype=numpy.float32)
+            samples[:self.count] = self.samples
+            self.samples = samples
+        self.samples[self.count] = (self.car.x, self.car.y, self.car.rotation)
+        self.count += 1
+        
+        if len(stats.lap_times) > self.laps:
+            # The car completed a lap during this step.
+            steps = self.count - self.lap_start
+            if self.best_steps is None or steps < self.best_steps:
+                self.best_steps = steps
+                self.best_lap = self.samples[self.lap_start:self.count].copy()
+            
+            self.laps = len(stats.lap_times)
+            self.lap_start = self.count
+    
+    def save(self):
+        """Writes the fastest lap, if it is faster than the best lap the
+           recorder started with. Returns whether a lap was written."""
+        if self.best_lap is None:
+            return False
+        
+        folder = os.path.dirname(self.filename)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        
+        tmp_filename = self.filename + '.tmp'
+        f = open(tmp_filename, 'wb')
+        try:
+            numpy.save(f, self.best_lap)
+        finally:
+            f.close()
+        
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(tmp_filename, self.filename)
+        
+        self.best_lap = None
+        return True
+
+
+class GhostPlayer(object):
+    """Looks up where a ghost is at a time in the current lap."""
+    
+    def __init__(self, samples, timestep):
+        self.samples = samples
+        self.timestep = timestep
+    
+    def get_sample(self, lap_time):
+        """Returns the (x, y, rotation) of the ghost after driving for
+           lap_time seconds, or None once it finished its lap."""
+        index = int(round(lap_time / self.timestep)) - 1
+        if index >= len(self.samples):
+            return None
+        x, y, rotation = self.samples[max(index, 0)]
+        return float(x), float(y), float(rotation)
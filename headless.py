@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of RCr and copyright (C) Maik Gosenshuis and 
+# Jeroen Tietema 2008-09.
+#
+# RCr is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RCr is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RCr.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Runs races without a window, sprites or sound. Import this module before
+any other module of the game when there is no display, e.g. on a server.
+
+Run from the root directory of the game to simulate a single race with
+computer controlled cars:
+
+    python headless.py [options] cup track
+"""
+
+import os
+import time
+from optparse import OptionParser
+
+import pyglet
+
+# pyglet normally creates a hidden window at import time to share its OpenGL
+# context with, which fails without a display. Races do not need OpenGL.
+pyglet.options['shadow_window'] = False
+
+import pyglet.resource
+
+pyglet.resource.path.extend([
+    'img',
+    os.path.join('cups', 'garden')
+])
+pyglet.resource.reindex()
+
+from simulation import TrackSurface, SimulatedCar, RaceSimulation
+
+
+# The parts of the cars when none are specified.
+DEFAULT_CAR = ('fellali', 'basic', 'second_hand')
+
+
+def load_surface(cup, track):
+    """Returns the TrackSurface of a track, with its overlay loaded."""
+    surface = TrackSurface(cup, track)
+    surface.load_overlay()
+    return surface
+
+
+def run_race(surface, configurations, time_limit=None):
+    """Races cars with the supplied (body, engine, tyres) part ids on a
+       TrackSurface. Returns the results as a list of Stats instances,
+       ordered by finishing position."""
+    cars = [SimulatedCar(*configuration) for configuration in configurations]
+    simulation = RaceSimulation(surface, cars)
+    return simulation.run(time_limit)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] cup track')
+    parser.add_option('-c', '--car', action='append', dest='cars', default=[],
+        metavar='BODY,ENGINE,TYRES', help='add a car with these parts (repeatable)')
+    parser.add_option('-n', '--num-cars', type='int', default=3,
+        help='number of default cars when no cars are given [default: %default]')
+    parser.add_option('-t', '--time-limit', type='float', default=600,
+        help='maximum race time in seconds [default: %default]')
+    options, args = parser.parse_args()
+    
+    if len(args) != 2:
+        parser.error('expected a cup and a track')
+    cup, track = args
+    
+    configurations = [tuple(car.split(',')) for car in options.cars]
+    if not configurations:
+        configurations = [DEFAULT_CAR] * options.num_cars
+    
+    surface = load_surface(cup, track)
+    
+    start = time.time()
+    results = run_race(surface, configurations, options.time_limit)
+    duration = time.time() - start
+    
+    for position, stats in enumerate(results):
+        print '%d. %-40s %8.2fs  %s' % (position + 1, stats.car.name, stats.total_time,
+            ' '.join(['%.2f' % lap_time for lap_time in stats.lap_times]))
+    
+    race_time = max([stats.total_time for stats in results])
+    print 'Simulated %.1fs of racing in %.2fs' % (race_time, duration)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,10 +26,14 @@ from car import ComputerCar
 
 class LoadTrack(Scene):
     
-    def __init__(self, track):
+    def __init__(self, track, streaming=True):
+        """In streaming mode the race starts as soon as the partitions
+           around the starting grid are loaded. The remaining partitions
+           are then loaded during the countdown."""
         Scene.__init__(self)
         self.text = 'Loading...'
         self.track = track
+        self.streaming = streaming
         self.layer = Layer()
         self.label = Label(self.text + '0%', position=(100,100))
         self.layer.add(self.label)
@@ -37,30 +41,38 @@ class LoadTrack(Scene):
         
         self.schedule(self.load_track)
         
-        self.images_loaded = False
-        self.overlay_loaded = False
+        # The images are decoded in a background thread; this scene only
+        # uploads the finished partitions.
+        self.track.start_loading()
     
     def load_track(self, dt, *args, **kwargs):
-        if not self.images_loaded:
-            self.track.load_images()
-            self.label.text = self.text + '5%'
-            self.total = len(self.track.partition_list)
-            self.images_loaded = True
-        elif not self.overlay_loaded:
-            self.track.load_overlay()
-            self.label.text = self.text + '25%'
-            self.overlay_loaded = True
+        partitions_left = self.track.load_partitions()
+        
+        if partitions_left is None:
+            # Still decoding the track image.
+            return
+        
+        if self.streaming:
+            required = self.track.get_partitions_in_view(self.track.get_start()[0][0],
+                (director.window.width, director.window.height))
+            required = [p for p in required if p in self.track.preload_list]
+        else:
+            required = self.track.preload_list
+        loaded = len(self.track.loaded_partitions.intersection(required))
+        
+        if self.track.overlay_data is None:
+            percent = 5
         else:
-            partitions_left = self.track.load_partitions()
-            percent = 25 + int(((self.total - partitions_left) * 1.0 / self.total) * 75)
-            self.label.text = self.text + str(percent) + '%'
-            if partitions_left == 0:
-                # load the music last
-                self.track.load_music()
-                # hack to prevent circular imports
-                from race import Race
-                race = Race(self.track, [state.profile.car, ComputerCar.get_default(),
-                    ComputerCar.get_default()])
-                director.replace(race)
+            percent = 25 + int((loaded * 1.0 / len(required)) * 75)
+        self.label.text = self.text + str(percent) + '%'
         
-    
\ No newline at end of file
+        if self.track.overlay_data is not None and loaded == len(required):
+            self.unschedule(self.load_track)
+            
+            # load the music last
+            self.track.load_music()
+            # hack to prevent circular imports
+            from race import Race
+            race = Race(self.track, [state.profile.car, ComputerCar.get_default(),
+                ComputerCar.get_default()])
+            director.replace(race)
@@ -17,6 +17,7 @@
 # along with RCr.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+from optparse import OptionParser
 
 from cocos.director import director
 import pyglet
@@ -25,6 +26,19 @@ from menu import MenuScene
 from cups import Cup
 import profiles
 from game_state import state
+import profiler
+import atlas
+
+parser = OptionParser(usage='%prog [options]')
+parser.add_option('--profile', action='store_true', default=False,
+    help='show how long the parts of every frame take')
+parser.add_option('--profile-csv', default=None, metavar='FILE',
+    help='write how long the parts of every frame take to FILE')
+options, args = parser.parse_args()
+
+stop_profiling = None
+if options.profile or options.profile_csv:
+    stop_profiling = profiler.install(options.profile, options.profile_csv)
 
 director.init(width=1024, height=768, caption="""RCr: Larry's Lawn""")
 
@@ -34,6 +48,8 @@ pyglet.resource.path.extend([
 ])
 pyglet.resource.reindex()
 
+atlas.manager.load()
+
 pyglet.font.add_directory('fonts')
 
 # TODO: non-fixed
@@ -42,3 +58,6 @@ state.cup = Cup('garden')
 menu_scene = MenuScene()
 
 director.run(menu_scene)
+
+if stop_profiling is not None:
+    stop_profiling()
@@ -17,12 +17,15 @@
 # along with RCr.  If not, see <http://www.gnu.org/licenses/>.
 
 import pyglet.image
+import pyglet.resource
 import bisect
 import os.path
 from ConfigParser import RawConfigParser
 
 from cocos.sprite import Sprite
 
+import atlas
+
 
 # Only expose manager singleton instance.
 __all__ = ['manager', 'CLASSES']
@@ -112,7 +115,7 @@ class Part(object):
             if self.image is None:
                 raise NotImplementedError("Part does not have an image.")
             
-            self._sprite = Sprite(self.image)
+            self._sprite = Sprite(atlas.manager.image(self.image))
         
         return self._sprite
     sprite = property(_get_sprite, doc="""Creates a sprite instance for the
@@ -132,6 +135,22 @@ class Body(Part):
         self.tyres_fy_offset = int(tyres_fy_offset)
         self.tyres_bx_offset = int(tyres_bx_offset)
         self.tyres_by_offset = int(tyres_by_offset)
+        
+        self._size = None
+    
+    def _get_size(self):
+        if self._size is None:
+            f = pyglet.resource.file(self.image)
+            try:
+                image = pyglet.image.load(self.image, file=f)
+            finally:
+                f.close()
+            self._size = (image.width, image.height)
+        
+        return self._size
+    size = property(_get_size, doc="""Returns the (width, height) of the
+        body's image. No texture is created for it, so this also works
+        without a window.""")
 
 
 class Engine(Part):
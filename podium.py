@@ -25,6 +25,7 @@ from pyglet.window import key
 
 from game_state import state
 import util
+import atlas
 
 
 BLOCK_WIDTH = 250
@@ -47,7 +48,7 @@ class Podium(Scene):
         
         center = director.window.width / 2
         
-        podium_sprite = Sprite('podium.png')
+        podium_sprite = Sprite(atlas.manager.image('podium.png'))
         podium_sprite.image_anchor_y = 0
         podium_sprite.x = center
         
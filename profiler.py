@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of RCr and copyright (C) Maik Gosenshuis and 
+# Jeroen Tietema 2008-09.
+#
+# RCr is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RCr is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RCr.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures how long the subsystems of the game take every frame.
+
+A FrameProfiler adds up the time spent in named sections of a frame and keeps
+the totals of the last WINDOW frames, to report rolling percentiles of them.
+install() times the sections of the game by wrapping the methods that run
+them, so nothing is measured, and nothing slows down, unless the game is
+started with one of the profiling options:
+
+    python main.py --profile
+    python main.py --profile-csv profile.csv
+
+The first shows the percentiles on top of every scene, the second writes them
+to a CSV file every REPORT_INTERVAL seconds. Sections include the sections
+nested in them, and the frame is the time between the ends of two frames.
+"""
+
+from timeit import default_timer
+
+import numpy
+import pyglet
+
+
+__all__ = ['FrameProfiler', 'ProfilerDisplay', 'ProfilerLog', 'install', 'SECTIONS']
+
+
+# The number of frames the percentiles are taken over.
+WINDOW = 300
+
+# The seconds between two reports of the percentiles.
+REPORT_INTERVAL = 1.0
+
+PERCENTILES = (50, 95, 99)
+
+# The name of the time between the ends of two frames.
+FRAME = 'frame'
+
+# The sections timed by install() in the order they are reported, with how
+# deep they are nested in the sections above them.
+SECTIONS = [
+    (FRAME, 0),
+    ('clock', 1),
+    ('race', 2),
+    ('ai', 3),
+    ('physics', 3),
+    ('overlay', 4),
+    ('checkpoints', 3),
+    ('collision', 3),
+    ('particles', 2),
+    ('draw', 1),
+]
+
+CSV_COLUMNS = ['time', 'section', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+
+
+class FrameProfiler(object):
+    """Adds up the time spent in named sections during every frame, and keeps
+       the totals of the last frames. A section that is entered again while
+       it runs, like a recursive method, is only counted once."""
+    
+    def __init__(self, names, window=WINDOW):
+        self.names = list(names)
+        if FRAME not in self.names:
+            self.names.insert(0, FRAME)
+        self.indices = dict([(name, i) for i, name in enumerate(self.names)])
+        
+        # The totals of the current frame, how many times every section is
+        # running and when it started.
+        self.totals = [0.0] * len(self.names)
+        self.running = [0] * len(self.names)
+        self.started = [0.0] * len(self.names)
+        
+        # The totals of the last frames, as a ring of columns.
+        self.samples = numpy.zeros((len(self.names), window))
+        self.frames = 0
+        self.frame_end = None
+    
+    def start(self, name):
+        i = self.indices[name]
+        self.running[i] += 1
+        if self.running[i] == 1:
+            self.started[i] = default_timer()
+    
+    def stop(self, name):
+        i = self.indices[name]
+        self.running[i] -= 1
+        if self.running[i] == 0:
+            self.totals[i] += default_timer() - self.started[i]
+    
+    def wrap(self, name, function):
+        """Returns a function that calls function and times it as part of
+           a section."""
+        def timed(*args, **kwargs):
+            self.start(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.stop(name)
+        return timed
+    
+    def instrument(self, owner, attribute, name):
+        """Times a method of a class or an object as part of a section from
+           now on."""
+        setattr(owner, attribute, self.wrap(name, getattr(owner, attribute)))
+    
+    def end_frame(self):
+        """Stores the totals of the frame that ended and starts the next."""
+        now = default_timer()
+        if self.frame_end is not None:
+            self.totals[self.indices[FRAME]] = now - self.frame_end
+            self.samples[:, self.frames % self.samples.shape[1]] = self.totals
+            self.frames += 1
+        self.frame_end = now
+        self.totals = [0.0] * len(self.names)
+    
+    def summarize(self):
+        """Returns the mean, the PERCENTILES and the maximum of every section
+           over the last frames in seconds, as a list of (name, summary)
+           tuples. The summaries are dictionaries like {'mean': 0.01,
+           'p50': 0.01, ...}; the list is empty before the first frame."""
+        count = min(self.frames, self.samples.shape[1])
+        if not count:
+            return []
+        
+        samples = self.samples[:, :count]
+        percentiles = numpy.percentile(samples, PERCENTILES, axis=1)
+        means = samples.mean(axis=1)
+        maxima = samples.max(axis=1)
+        
+        result = []
+        for i, name in enumerate(self.names):
+            summary = {'mean': means[i], 'max': maxima[i]}
+            for j, percentile in enumerate(PERCENTILES):
+                summary['p%d' % percentile] = percentiles[j, i]
+            result.append((name, summary))
+        return result
+
+
+class ProfilerDisplay(object):
+    """Shows the percentiles of the sections in the lower left corner of the
+       window, drawn after the running scene."""
+    
+    def __init__(self, depths):
+        self.depths = depths
+        self.text = ''
+        
+        # The label needs a window to render to, so it is only made once the
+        # first frame is drawn.
+        self.label = None
+    
+    def update(self, dt, summaries):
+        lines = ['%-16s %6s %6s %6s' % (('ms',) + tuple(['p%d' % p for p in PERCENTILES]))]
+        for name, summary in summaries:
+            name = '  ' * self.depths.get(name, 0) + name
+            lines.append('%-16s' % name + ''.join([' %6.2f' % (summary['p%d' % p] * 1000)
+                for p in PERCENTILES]))
+        self.text = '\n'.join(lines)
+    
+    def draw(self):
+        if self.label is None:
+            self.label = pyglet.text.Label('', font_name='Courier New', font_size=9,
+                x=10, y=10, anchor_y='bottom', width=320, multiline=True,
+                color=(255, 255, 0, 255))
+        if self.label.text != self.text:
+            self.label.text = self.text
+        self.label.draw()
+
+
+class ProfilerLog(object):
+    """Writes the percentiles of the sections to a CSV file, a row for every
+       section at every report."""
+    
+    def __init__(self, filename):
+        self.file = open(filename, 'w')
+        self.file.write(','.join(CSV_COLUMNS) + '\n')
+        
+        # The seconds since the log was started.
+        self.time = 0
+    
+    def update(self, dt, summaries):
+        self.time += dt
+        for name, summary in summaries:
+            row = ['%.1f' % self.time, name]
+            for key in ('mean',) + tuple(['p%d' % p for p in PERCENTILES]) + ('max',):
+                row.append('%.3f' % (summary[key] * 1000))
+            self.file.write(','.join(row) + '\n')
+        self.file.flush()
+    
+    def close(self):
+        self.file.close()
+
+
+def install(show=True, csv_filename=None):
+    """Times the SECTIONS of the game from now on. Shows the percentiles on
+       top of every scene when show is set, and writes them to csv_filename
+       when it is given. Has to be called before director.init(), which
+       installs the method that draws the frames. Returns a function that
+       stops writing the CSV file."""
+    from cocos.director import Director
+    from cocos.scene import Scene
+    from cocos.particle import ParticleSystem
+    
+    import simulation
+    import race
+    
+    profiler = FrameProfiler([name for name, depth in SECTIONS])
+    profiler.instrument(pyglet.clock.Clock, 'tick', 'clock')
+    profiler.instrument(race.Race, 'update', 'race')
+    profiler.instrument(race.Replay, 'update', 'race')
+    profiler.instrument(simulation.CarPhysics, 'follow_path', 'ai')
+    profiler.instrument(simulation.ComputerDrivers, 'control', 'ai')
+    profiler.instrument(simulation.CarFleet, 'move', 'physics')
+    profiler.instrument(simulation.TrackSurface, 'sample_many', 'overlay')
+    profiler.instrument(simulation.RaceSimulation, 'update_stats', 'checkpoints')
+    profiler.instrument(simulation.RaceSimulation, 'collide_cars', 'collision')
+    profiler.instrument(ParticleSystem, 'step', 'particles')
+    profiler.instrument(Scene, 'visit', 'draw')
+    
+    display = None
+    if show:
+        display = ProfilerDisplay(dict(SECTIONS))
+    log = None
+    if csv_filename:
+        log = ProfilerLog(csv_filename)
+    
+    draw_frame = Director.on_draw
+    def on_draw(self):
+        draw_frame(self)
+        if display is not None:
+            display.draw()
+        profiler.end_frame()
+    Director.on_draw = on_draw
+    
+    def report(dt):
+        summaries = profiler.summarize()
+        if display is not None:
+            display.update(dt, summaries)
+        if log is not None:
+            log.update(dt, summaries)
+    pyglet.clock.schedule_interval(report, REPORT_INTERVAL)
+    
+    def stop():
+        pyglet.clock.unschedule(report)
+        if log is not None:
+            log.close()
+    return stop
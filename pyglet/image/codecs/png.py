@@ -33,12 +33,20 @@
 # ----------------------------------------------------------------------------
 
 '''Encoder and decoder for PNG files, using PyPNG (pypng.py).
+
+If NumPy is available, non-interlaced 8-bit images are decoded without
+PyPNG: the image data is inflated with zlib in one go and the scanline
+filters are undone with NumPy.
 '''
 
 __docformat__ = 'restructuredtext'
 __version__ = '$Id: $'
 
 import array
+import ctypes
+import struct
+import zlib
+from StringIO import StringIO
 
 from pyglet.gl import *
 from pyglet.image import *
@@ -46,11 +54,162 @@ from pyglet.image.codecs import *
 
 import pyglet.image.codecs.pypng
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_signature = struct.pack('8B', 137, 80, 78, 71, 13, 10, 26, 10)
+
+# Map PNG colour type to image format.
+_color_type_formats = {
+    0: 'L',
+    2: 'RGB',
+    4: 'LA',
+    6: 'RGBA',
+}
+
+def _read_chunks(data):
+    '''Yield the (tag, data) of each chunk in a PNG file's contents.'''
+    if data[:8] != _signature:
+        raise ImageDecodeException('PNG file has invalid header')
+    offset = 8
+    while offset < len(data):
+        try:
+            length, tag = struct.unpack('!I4s', data[offset:offset + 8])
+        except struct.error:
+            raise ImageDecodeException('Chunk too short for header')
+        chunk = data[offset + 8:offset + 8 + length]
+        checksum = data[offset + 8 + length:offset + 12 + length]
+        if len(chunk) != length or len(checksum) != 4:
+            raise ImageDecodeException('Chunk %s is truncated' % tag)
+        if struct.pack('!i', zlib.crc32(chunk, zlib.crc32(tag))) != checksum:
+            raise ImageDecodeException('Checksum error in %s chunk' % tag)
+        yield tag, chunk
+        if tag == 'IEND':
+            break
+        offset += length + 12
+
+def _unfilter_rows(lines, filters, psize):
+    '''Undo the None, Sub and Up filters one row at a time.'''
+    height, row_bytes = lines.shape
+    pixels = numpy.empty((height, row_bytes), numpy.uint8)
+    prior = numpy.zeros(row_bytes, numpy.uint8)
+    for y in range(height):
+        line = lines[y]
+        row = pixels[y]
+        filter_type = filters[y]
+        if filter_type == 0:
+            row[:] = line
+        elif filter_type == 1:
+            # Running sum of each sample, wrapping around at 256.
+            numpy.cumsum(line.reshape((-1, psize)), axis=0, dtype=numpy.uint8,
+                         out=row.reshape((-1, psize)))
+        else:
+            numpy.add(line, prior, row)
+        prior = row
+    return pixels
+
+def _unfilter_diagonals(lines, filters, psize):
+    '''Undo any mix of scanline filters.
+
+    Average and Paeth make every pixel depend on its reconstructed left
+    neighbour, so a row can not be undone in one vectorized step. A pixel
+    only depends on its left, upper and upper-left neighbours though, so
+    all pixels on one anti-diagonal can be reconstructed together. This
+    takes width + height - 1 steps for the whole image.
+    '''
+    height, row_bytes = lines.shape
+    width = row_bytes // psize
+    source = lines.reshape((height * width, psize))
+
+    # Reconstructed pixels with an extra row of zeros above and an extra
+    # column of zeros to the left, so no edge cases are needed for the
+    # neighbours of the first row and column.
+    stride = width + 1
+    padded = numpy.zeros(((height + 1) * stride, psize), numpy.uint8)
+
+    rows = numpy.arange(height)
+    filters = filters.astype(numpy.intp)[:, numpy.newaxis]
+    zero = numpy.zeros((min(width, height), psize), numpy.int16)
+    for k in range(width + height - 1):
+        y0 = max(0, k - width + 1)
+        y1 = min(height, k + 1)
+        ys = rows[y0:y1]
+        target = (ys + 1) * stride + (k - ys) + 1
+
+        a = padded.take(target - 1, axis=0).astype(numpy.int16)
+        b = padded.take(target - stride, axis=0).astype(numpy.int16)
+        c = padded.take(target - stride - 1, axis=0).astype(numpy.int16)
+
+        pa = numpy.abs(b - c)
+        pb = numpy.abs(a - c)
+        pc = numpy.abs(a + b - 2 * c)
+        paeth = numpy.where((pa <= pb) & (pa <= pc), a,
+                            numpy.where(pb <= pc, b, c))
+        predictor = numpy.choose(filters[y0:y1],
+            (zero[:len(ys)], a, b, (a + b) >> 1, paeth))
+
+        predictor += source.take(ys * width + (k - ys), axis=0)
+        padded[target] = predictor & 0xff
+    return padded.reshape((height + 1, stride * psize))[1:, psize:]
+
+def _decode_fast(data):
+    '''Decode a non-interlaced 8-bit PNG using NumPy.
+
+    Returns a (width, height, format, pixels) tuple, where pixels is a
+    ctypes array sharing its memory with the decoded image, rows ordered
+    top to bottom. Returns None if the image needs the PyPNG decoder.
+    '''
+    header = None
+    compressed = []
+    for tag, chunk in _read_chunks(data):
+        if tag == 'IHDR':
+            header = struct.unpack('!2I5B', chunk)
+        elif tag == 'IDAT':
+            compressed.append(chunk)
+    if header is None:
+        raise ImageDecodeException('PNG file has no IHDR chunk')
+
+    (width, height, bit_depth, color_type,
+     compression, filter_method, interlaced) = header
+    if (bit_depth != 8 or interlaced or compression or filter_method or
+        color_type not in _color_type_formats):
+        return None
+
+    format = _color_type_formats[color_type]
+    psize = len(format)
+    scanlines = numpy.frombuffer(zlib.decompress(''.join(compressed)),
+                                 numpy.uint8)
+    scanlines = scanlines.reshape((height, width * psize + 1))
+    filters = scanlines[:, 0]
+    lines = scanlines[:, 1:]
+
+    if filters.max() > 4:
+        raise ImageDecodeException('Unknown PNG filter type')
+    if filters.max() > 2:
+        pixels = _unfilter_diagonals(lines, filters, psize)
+    else:
+        pixels = _unfilter_rows(lines, filters, psize)
+
+    pixels = numpy.ascontiguousarray(pixels)
+    pixel_buffer = (ctypes.c_ubyte * pixels.size).from_buffer(pixels)
+    return width, height, format, pixel_buffer
+
 class PNGImageDecoder(ImageDecoder):
     def get_file_extensions(self):
         return ['.png']
 
     def decode(self, file, filename):
+        if numpy is not None:
+            data = file.read()
+            result = _decode_fast(data)
+            if result is not None:
+                width, height, format, pixels = result
+                return ImageData(width, height, format, pixels,
+                                 -width * len(format))
+            file = StringIO(data)
+
         try:
             reader = pyglet.image.codecs.pypng.Reader(file=file)
             width, height, pixels, metadata = reader.read()
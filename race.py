@@ -32,9 +32,13 @@ from cocos.actions.interval_actions import ScaleTo, Delay, MoveTo, AccelDeccel
 import pyglet.media
 
 from game_state import state
-from car import PlayerCar, ComputerCar
+from car import Car, PlayerCar, ComputerCar, GhostCar, CarBatch
 from podium import Podium
+from simulation import RaceSimulation
+from replay import ReplayRecorder, ReplayReader, ReplayPlayer, LAST_REPLAY
+from ghost import GhostRecorder, GhostPlayer, get_ghost_path, load_ghost
 import util
+import atlas
 
 
 SHORT_BEEP_SOUND = pyglet.media.load(os.path.join('sound', 'short_beep.wav'), streaming=False)
@@ -56,8 +60,6 @@ class Race(Scene):
         
         self.player_finished = False
         
-        self.results = []
-        
         self.track_layer = ScrollableLayer()
         self.track_layer.px_width = track.get_size()[0]
         self.track_layer.px_height = track.get_size()[1]
@@ -67,30 +69,26 @@ class Race(Scene):
         self.cars = cars
         self.cars_layer = ScrollableLayer()
         
+        # The cars, and the dirt behind them, are drawn all at once.
+        self.cars_batch = CarBatch()
+        self.cars_layer.add(self.cars_batch)
+        
         self.scroller = ScrollingManager()
         self.scroller.add(self.track_layer, z=-1)
         self.scroller.add(self.cars_layer)
         
-        num_player_cars = 0
-        self.stats = {}
+        # The simulation resets the cars and puts them on the starting grid.
+        self.simulation = RaceSimulation(track.surface, cars)
+        self.stats = self.simulation.stats
+        self.results = self.simulation.results
         
-        # define start grid
-        i = 0
-        grid = track.get_start()
+        num_player_cars = 0
         for car in self.cars:
             # Add the car to the cars layer.
-            self.cars_layer.add(car)
-            
-            # Reset the car's state.
-            car.reset()
+            self.cars_batch.add(car)
             
             car.resume_sounds()
             
-            # Set the car's position.
-            car.position = grid[i][0]
-            car.rotation = grid[i][1]
-            i += 1
-            
             # Add the track to the car
             car.track = track
             
@@ -98,11 +96,11 @@ class Race(Scene):
                 num_player_cars += 1
                 self.scroller.set_focus(*car.position)
                 self.player_car = car
-            
-            self.stats[car] = Stats(car)
         
         assert num_player_cars == 1
         
+        self.add_ghost()
+        
         self.hud = HUD(self.track.get_laps())
         
         self.add(self.scroller, z=0)
@@ -110,6 +108,13 @@ class Race(Scene):
         
         self.menu = None
         
+        # Records the race once it starts, see start_recording().
+        self.recorder = None
+        self.ghost_recorder = None
+        
+        # Set while the replay pushed by watch_replay() is shown.
+        self.watching_replay = False
+        
         self.add_traffic_lights()
         
         self.scroller.is_event_handler = True
@@ -126,6 +131,34 @@ class Race(Scene):
             self.remove(self.menu)
             self.menu = None
         
+    def add_ghost(self):
+        """Adds a ghost car driving the fastest lap of the player on this
+           track, if there is one. The lap is memory-mapped, so it is only
+           read as the ghost drives."""
+        surface = self.track.surface
+        self.ghost_path = get_ghost_path(state.profile.name, surface.cup, surface.name)
+        self.ghost_lap = load_ghost(self.ghost_path)
+        
+        self.ghost = None
+        if self.ghost_lap is not None:
+            self.ghost_player = GhostPlayer(self.ghost_lap, self.simulation.timestep)
+            self.ghost = GhostCar(self.player_car.body, self.player_car.tyres)
+            self.ghost.visible = False
+            self.cars_layer.add(self.ghost, z=-1)
+    
+    def update_ghost(self):
+        """Moves the ghost to where it was at the current lap time of the
+           player."""
+        stats = self.stats[self.player_car]
+        sample = None
+        if self.started and not stats.finished:
+            sample = self.ghost_player.get_sample(stats.current_lap_time)
+        
+        self.ghost.visible = sample is not None
+        if sample is not None:
+            x, y, self.ghost.rotation = sample
+            self.ghost.position = (x, y)
+    
     def add_traffic_lights(self):
         lights = TrafficLights()
         
@@ -149,138 +182,104 @@ class Race(Scene):
         )
         
     def update(self, dt):
-        """Updates all the cars once the race has started."""        
+        """Advances the race simulation and shows the new state of the
+           cars once the race has started."""
+        self.simulation.advance(dt)
+        
+        if self.ghost is not None:
+            self.update_ghost()
+        
         for car in self.cars:
-            # update the car
-            car.update(dt)
+            car.update_effects()
             
             if car is not self.player_car:
                 # Change engine sound accordingly.
                 car.move_sound_relative(self.player_car.position)
-            
-            # Create a short-named reference.
-            stats = self.stats[car]
-            
-            # update checkpoints
-            checkpoint_stage = self.track.get_checkpoint_stage_at(car.position)
-            next_checkpoint_stage = (stats.last_checkpoint_stage + 1) % 3
-            
-            if checkpoint_stage == next_checkpoint_stage:
-                # Car changed checkpoint stage and is driving in the right
-                # direction.
-                if checkpoint_stage == 2:
-                    stats.checkpoints += 1
-            elif checkpoint_stage <> stats.last_checkpoint_stage and stats.last_checkpoint_stage > -1:
-                # Car changed checkpoint stage and is driving the wrong way.
-                print car, 'WRONG WAY!', stats.last_checkpoint_stage, checkpoint_stage
-                if checkpoint_stage == 1:
-                    stats.checkpoints -= 1
-            
-            stats.last_checkpoint_stage = checkpoint_stage
-            
-            stats.current_lap_time += dt
-            
-            # update laps
-            if stats.checkpoints == self.track.get_checkpoints():
-                # At finish.
-                stats.checkpoints = 0
-                
-                # Store the lap time and reset the current lap time.
-                stats.lap_times.append(stats.current_lap_time)
-                stats.current_lap_time = 0
-                
-                if stats.laps >= self.track.get_laps():                    
-                    # Stop the car, disabling any controls in the process.
-                    print car, 'Finished'
-                    
-                    car.stop()
-                    
-                    stats.finished = True
-                    self.add_result(stats)
-                else:
-                    stats.laps += 1
-                    
-            if isinstance(car, PlayerCar) and not self.player_finished:
-                if stats.finished:
-                    # The race is over since the player car finished.
-                    self.finish()
-                else:
-                    self.hud.update_laps(stats.laps)
-                    self.scroller.set_focus(*car.position)
-        
-        # do collision detection
-        
-        # make a copy of cars list to prevent duplicate collision checks
-        cars = self.cars[:]
-        # iterate over all cars
-        for car in self.cars:
-            # remove car from the te list to prevent detecting collision with self
-            cars.remove(car)
-            # iterate over remaining cars
-            for othercar in cars:
-                polygon = car.get_polygon()
-                other_polygon = othercar.get_polygon()
-                if polygon.intersects(other_polygon):
-                    self.resolve_collision(car, othercar)
-                    
-    def resolve_collision(self, car1, car2):
-        diff_x = abs(car1.x - car2.x)
-        diff_y = abs(car1.y - car2.y)
-        collision = True
-        while collision:
-            if diff_y > diff_x:
-                # resolve collision in y axis
-                if car1.y > car2.y:
-                    car1.y += 1
-                    car2.y -= 1
-                else:
-                    car1.y -= 1
-                    car2.y += 1
+        
+        if not self.player_finished:
+            stats = self.stats[self.player_car]
+            if stats.finished:
+                # The race is over since the player car finished.
+                self.finish()
             else:
-                # resolve collision in x axis
-                if car1.x > car2.x:
-                    car1.x += 1
-                    car2.x -= 1
-                else:
-                    car1.x -= 1
-                    car2.x += 1
-            
-            poly1 = car1.get_polygon()
-            poly2 = car2.get_polygon()
-            collision = poly1.intersects(poly2)
+                self.hud.update_laps(stats.laps)
+                self.scroller.set_focus(*self.player_car.position)
+        
+        # Only the dirt in view is simulated in full.
+        layer = self.cars_layer
+        self.cars_batch.set_view(layer.view_x, layer.view_y, layer.view_w, layer.view_h)
     
-    def add_result(self, stats):
-        """Returns a list with all the Stats instances sorted ascendingly
-           by total lap time."""
-        assert stats not in self.results
-
-        self.results.append(stats)
-
-        print 'RESULTS', self.results
-
     def autocomplete_results(self):
         """Automatically fills in a custom time for all cars that did not
            finish yet."""
-        for stats in self.stats.values():
-            if not stats.finished:
-                assert stats not in self.results
-
-                stats.total_time = self.results[-1].total_time + 30
-                stats.finished = True
-                self.results.append(stats)
-
+        self.simulation.autocomplete_results()
+        
         print 'RESULTS', self.results
     
     def start(self):
         self.started = True
         
+        self.start_recording()
         self.schedule(self.update)
     
+    def start_recording(self):
+        """Records the race to LAST_REPLAY, so it can be watched again."""
+        try:
+            self.recorder = ReplayRecorder(LAST_REPLAY, self.simulation,
+                focus=self.cars.index(self.player_car))
+        except (IOError, OSError):
+            # Racing is still possible without replays.
+            self.recorder = None
+        self.simulation.recorder = self.recorder
+        
+        # Keeps the fastest lap of the player as the ghost of the track.
+        self.ghost_recorder = GhostRecorder(self.ghost_path, self.player_car, self.ghost_lap)
+        self.simulation.ghost_recorder = self.ghost_recorder
+    
+    def save_ghost(self):
+        """Writes the ghost when the player drove a lap faster than the
+           ghost did."""
+        if self.ghost_recorder is None:
+            return
+        
+        # Let go of the old ghost first, as its file is memory-mapped.
+        if self.ghost is not None:
+            self.cars_layer.remove(self.ghost)
+            self.ghost = None
+            self.ghost_player = None
+        self.ghost_lap = None
+        
+        try:
+            self.ghost_recorder.save()
+        except (IOError, OSError):
+            pass
+    
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.simulation.recorder = None
+            try:
+                self.recorder.close()
+            except (IOError, OSError):
+                pass
+            self.recorder = None
+    
+    def watch_replay(self):
+        """Shows the replay of the race so far. The track is lent to the
+           replay scene and added back in on_enter."""
+        self.stop_recording()
+        
+        if os.path.exists(LAST_REPLAY):
+            self.track_layer.remove(self.track)
+            self.watching_replay = True
+            director.push(Replay(self.track, LAST_REPLAY))
+    
     def finish(self):
         """Displays a message explaining the player that he finished.
            Also automatically progresses to the results screen."""
         self.player_finished = True
         
+        self.save_ghost()
+        
         # state.cup.set_results_for_current_track(self.results)
         
         player_position = self.results.index(self.stats[self.player_car]) + 1
@@ -322,44 +321,119 @@ class Race(Scene):
         
         state.cup.set_results_for_current_track(self.results)
     
+    def on_enter(self):
+        super(Race, self).on_enter()
+        
+        if self.track not in self.track_layer.get_children():
+            self.track_layer.add(self.track)
+        
+        if self.watching_replay:
+            self.watching_replay = False
+            for car in self.cars:
+                car.resume_sounds()
+    
     def on_exit(self):
         super(Race, self).on_exit()
         
         for car in self.cars:
             car.pause_sounds()
         
+        # The race goes on after a replay, so keep the music playing and the
+        # ghost in place.
+        if self.watching_replay:
+            return
+        
+        self.stop_recording()
+        self.save_ghost()
+        
         self.track.stop_music()
 
 
-class Stats():
-    def __init__(self, car):
-        self.car = car
+class Replay(Scene):
+    """Plays back a replay on a loaded track. The cars only follow the
+       recorded controls, so the computer drivers do not run again."""
+    
+    def __init__(self, track, filename):
+        Scene.__init__(self)
         
-        # Timer for the current lap.
-        self.current_lap_time = 0
+        self.reader = ReplayReader(filename)
+        self.track = track
         
-        # A list of lap times.
-        self.lap_times = []
+        self.track_layer = ScrollableLayer()
+        self.track_layer.px_width = track.get_size()[0]
+        self.track_layer.px_height = track.get_size()[1]
+        self.track_layer.add(track)
         
-        # The lap the car is currently in.
-        self.laps = 1
+        self.cars = [Car(body=body, engine=engine, tyres=tyres)
+            for name, body, engine, tyres in self.reader.cars]
+        self.cars_layer = ScrollableLayer()
+        self.cars_batch = CarBatch()
+        self.cars_layer.add(self.cars_batch)
+        for car in self.cars:
+            self.cars_batch.add(car)
+        self.focus_car = self.cars[self.reader.focus]
         
-        # The last checkpoint stage the car was in.
-        self.last_checkpoint_stage = -1
+        self.scroller = ScrollingManager()
+        self.scroller.add(self.track_layer, z=-1)
+        self.scroller.add(self.cars_layer)
+        self.add(self.scroller, z=0)
+        
+        self.simulation = RaceSimulation(track.surface, self.cars, self.reader.timestep)
+        self.simulation.replay = ReplayPlayer(self.reader)
+        self.scroller.set_focus(*self.focus_car.position)
+        
+        label = util.Label(text='Replay', font_size=25, background=(0, 0, 0, 125),
+            anchor_y='bottom')
+        label.y = director.window.height - label.height
+        self.add(label, z=1)
+        
+        self.scroller.is_event_handler = True
+        self.scroller.on_key_press = self.on_key_press
+    
+    def on_key_press(self, symbol, modifier):
+        if symbol == key.ESCAPE:
+            director.pop()
+            return True
+    
+    def on_enter(self):
+        super(Replay, self).on_enter()
         
-        # The number of check points passed since the finish. Set to -1
-        # initially to compensate for a starting grid before the finish
-        # line.
-        self.checkpoints = -1
+        for car in self.cars:
+            car.resume_sounds()
         
-        # Reflects if this car finished the race.
-        self.finished = False
+        self.schedule(self.update)
     
-    def __cmp__(self, other):
-        return cmp(self.total_time, other.total_time)
+    def update(self, dt):
+        self.simulation.advance(dt)
+        
+        for car in self.cars:
+            car.update_effects()
+            
+            if car is not self.focus_car:
+                car.move_sound_relative(self.focus_car.position)
+        
+        self.scroller.set_focus(*self.focus_car.position)
+        
+        layer = self.cars_layer
+        self.cars_batch.set_view(layer.view_x, layer.view_y, layer.view_w, layer.view_h)
+        
+        if self.simulation.replay.finished:
+            self.unschedule(self.update)
+            director.pop()
     
-    total_time = property(lambda self: sum(self.lap_times),
-        doc="Returns the sum of all the lap times.")
+    def on_exit(self):
+        super(Replay, self).on_exit()
+        
+        self.unschedule(self.update)
+        
+        for car in self.cars:
+            car.pause_sounds()
+        
+        # Give the track back to the race.
+        if self.track in self.track_layer.get_children():
+            self.track_layer.remove(self.track)
+        
+        self.reader.close()
 
 
 class HUD(Layer):
@@ -390,7 +464,7 @@ class TrafficLights(CocosNode):
     def __init__(self):
         super(TrafficLights, self).__init__()
         
-        self.image_sprite = Sprite('traffic_lights.png')
+        self.image_sprite = Sprite(atlas.manager.image('traffic_lights.png'))
         self.image_sprite.image_anchor_y = 0
         self.add(self.image_sprite, z=1)
         
@@ -453,11 +527,13 @@ class ResultsMenu(menu.Menu):
         if state.cup.has_next_track():
             items = [
                 menu.MenuItem('Next race', self.on_next_race),
+                menu.MenuItem('Watch replay', self.on_watch_replay),
                 menu.MenuItem('Back to Main Menu', self.on_back)
             ]
         else:
             items = [
-                menu.MenuItem('Proceed', self.on_proceed)
+                menu.MenuItem('Proceed', self.on_proceed),
+                menu.MenuItem('Watch replay', self.on_watch_replay)
             ]
 
         self.create_menu(items, menu.shake(), menu.shake_back())
@@ -472,6 +548,9 @@ class ResultsMenu(menu.Menu):
         from loading import LoadTrack
         director.replace(LoadTrack(state.cup.next_track()))
 
+    def on_watch_replay(self):
+        self.get_ancestor(Race).watch_replay()
+    
     def on_back(self):
         state.cup = None
         director.pop()
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of RCr and copyright (C) Maik Gosenshuis and 
+# Jeroen Tietema 2008-09.
+#
+# RCr is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RCr is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RCr.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Records races and plays them back.
+
+A replay holds the controls (accel_dir and rot_dir) of every car for every
+step of the RaceSimulation, plus a keyframe with the position, rotation and
+speed of all cars every KEYFRAME_INTERVAL steps. Playing it back feeds the
+controls to the simulation instead of the drivers, so the computer drivers
+do not run again. While recording, the cars are rounded to the stored
+keyframe values, so the replay follows the race exactly.
+
+The file starts with a header (see ReplayRecorder.write_header), followed by
+a zlib stream of records. Every record starts with the number of steps
+since the previous record as a varint, followed by:
+
+- RECORD_INPUT | controls, then the index of the car as a varint: the
+  controls of a car changed.
+- RECORD_KEYFRAME, then x, y, rotation and speed of every car, quantized
+  and stored as zigzag varints relative to the previous keyframe.
+- RECORD_END: the end of the replay.
+"""
+
+import os
+import struct
+import zlib
+
+from util import signum
+
+
+__all__ = ['ReplayRecorder', 'ReplayReader', 'ReplayPlayer', 'REPLAY_FOLDER',
+    'LAST_REPLAY']
+
+
+REPLAY_FOLDER = os.path.expanduser('~/.RCr_replays')
+
+# The replay of the last race that was driven.
+LAST_REPLAY = os.path.join(REPLAY_FOLDER, 'last.rcr')
+
+MAGIC = 'RCRR'
+VERSION = 2
+
+# The number of simulation steps between keyframes.
+KEYFRAME_INTERVAL = 300
+
+# The number of steps after which the recorded data is compressed and
+# written, so memory use does not grow with the length of a race.
+FLUSH_INTERVAL = 600
+
+# The number of compressed bytes read at once while playing back.
+READ_SIZE = 4096
+
+# Keyframe values are stored as integers in these units.
+POSITION_SCALE = 256.0
+ROTATION_SCALE = 256.0
+SPEED_SCALE = 256.0
+
+RECORD_END = 0x00
+RECORD_KEYFRAME = 0x01
+RECORD_INPUT = 0x80
+
+
+class ReplayError(Exception):
+    pass
+
+
+def encode_varint(number):
+    """Encodes a non-negative integer in 7 bit groups, least significant
+       group first."""
+    data = []
+    while number >= 0x80:
+        data.append(chr(number & 0x7f | 0x80))
+        number >>= 7
+    data.append(chr(number))
+    return ''.join(data)
+
+
+def encode_signed(number):
+    """Encodes an integer as a varint, mapping small negative numbers to
+       small positive numbers (zigzag encoding)."""
+    if number < 0:
+        return encode_varint(-number * 2 - 1)
+    return encode_varint(number * 2)
+
+
+def encode_controls(car):
+    """Returns the controls of a car as a number between 0 and 8."""
+    return (signum(car.accel_dir) + 1) * 3 + signum(car.rot_dir) + 1
+
+
+def decode_controls(code):
+    """Returns the (accel_dir, rot_dir) encoded by encode_controls."""
+    return code / 3 - 1, code % 3 - 1
+
+
+def quantize(car):
+    return (int(round(car.x * POSITION_SCALE)), int(round(car.y * POSITION_SCALE)),
+        int(round(car.rotation * ROTATION_SCALE)), int(round(car.speed * SPEED_SCALE)))
+
+
+def set_keyframe(car, (x, y, rotation, speed)):
+    """Sets the state of a car to the values returned by quantize()."""
+    car.x = x / POSITION_SCALE
+    car.y = y / POSITION_SCALE
+    car.rotation = rotation / ROTATION_SCALE
+    car.speed = speed / SPEED_SCALE
+
+
+def pack_string(text):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return struct.pack('<H', len(text)) + text
+
+
+class ReplayRecorder(object):
+    """Writes a replay of a RaceSimulation while it runs. Set it as the
+       recorder of the simulation, which then calls record() every step.
+       The replay is written to a temporary file, which replaces the
+       supplied file once the recorder is closed."""
+    
+    def __init__(self, filename, simulation, focus=0):
+        """Focus is the index of the car the replay should follow."""
+        self.filename = filename
+        self.tmp_filename = filename + '.tmp'
+        
+        folder = os.path.dirname(filename)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        
+        self.file = open(self.tmp_filename, 'wb')
+        self.compressor = zlib.compressobj(9)
+        
+        self.tick = 0
+        self.last_record = 0
+        self.buffer = []
+        
+        self.controls = [None] * len(simulation.cars)
+        self.keyframe = [(0, 0, 0, 0)] * len(simulation.cars)
+        
+        self.write_header(simulation, focus)
+    
+    def write_header(self, simulation, focus):
+        """The header holds the track and the parts of the cars, which is
+           needed to set up the race again."""
+        header = [struct.pack('<4sBHd', MAGIC, VERSION, KEYFRAME_INTERVAL, simulation.timestep)]
+        header.append(pack_string(simulation.surface.cup))
+        header.append(pack_string(simulation.surface.name))
+        header.append(struct.pack('<HH', len(simulation.cars), focus))
+        for car in simulation.cars:
+            header.append(pack_string(getattr(car, 'name', '')))
+            for part in (car.body, car.engine, car.tyres):
+                header.append(pack_string(part.part_id))
+        self.file.write(''.join(header))
+    
+    def add_record(self, data):
+        self.buffer.append(encode_varint(self.tick - self.last_record))
+        self.buffer.append(data)
+        self.last_record = self.tick
+    
+    def record(self, simulation):
+        """Records the controls of the cars for the current step, and a
+           keyframe every KEYFRAME_INTERVAL steps."""
+        if self.tick % KEYFRAME_INTERVAL == 0:
+            data = [chr(RECORD_KEYFRAME)]
+            for i, car in enumerate(simulation.cars):
+                values = quantize(car)
+                for value, previous in zip(values, self.keyframe[i]):
+                    data.append(encode_signed(value - previous))
+                self.keyframe[i] = values
+                
+                # Round the cars to the stored values as well, so the replay
+                # starts every keyframe from exactly the same state.
+                set_keyframe(car, values)
+            simulation.fleet.gather()
+            self.add_record(''.join(data))
+        
+        for i, car in enumerate(simulation.cars):
+            code = encode_controls(car)
+            if code != self.controls[i]:
+                self.add_record(chr(RECORD_INPUT | code) + encode_varint(i))
+                self.controls[i] = code
+        
+        self.tick += 1
+        if self.tick % FLUSH_INTERVAL == 0:
+            self.flush()
+    
+    def flush(self):
+        self.file.write(self.compressor.compress(''.join(self.buffer)))
+        self.buffer = []
+    
+    def close(self):
+        """Finishes the replay and moves it in place."""
+        if self.file is None:
+            return
+        
+        self.add_record(chr(RECORD_END))
+        self.flush()
+        self.file.write(self.compressor.flush())
+        self.file.close()
+        self.file = None
+        
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(self.tmp_filename, self.filename)
+
+
+class ReplayReader(object):
+    """Reads a replay written by ReplayRecorder. The records are
+       decompressed while they are read, so only a small part of the
+       replay is in memory at once."""
+    
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        self.decompressor = zlib.decompressobj()
+        self.data = ''
+        self.offset = 0
+        
+        self.read_header()
+    
+    def read_exactly(self, size):
+        data = self.file.read(size)
+        if len(data) != size:
+            raise ReplayError('Unexpected end of replay header')
+        return data
+    
+    def read_string(self):
+        length, = struct.unpack('<H', self.read_exactly(2))
+        return self.read_exactly(length)
+    
+    def read_header(self):
+        magic, version, self.keyframe_interval, self.timestep = struct.unpack('<4sBHd',
+            self.read_exactly(struct.calcsize('<4sBHd')))
+        if magic != MAGIC:
+            raise ReplayError('Not a replay file')
+        if version != VERSION:
+            raise ReplayError('Unsupported replay version %d' % version)
+        
+        self.cup = self.read_string()
+        self.track = self.read_string()
+        
+        num_cars, self.focus = struct.unpack('<HH', self.read_exactly(4))
+        
+        # A (name, body, engine, tyres) tuple per car.
+        self.cars = []
+        for i in range(num_cars):
+            name = self.read_string().decode('utf-8')
+            self.cars.append((name, self.read_string(), self.read_string(), self.read_string()))
+    
+    def read_byte(self):
+        if self.offset == len(self.data):
+            compressed = self.file.read(READ_SIZE)
+            if compressed:
+                self.data = self.decompressor.decompress(compressed)
+            else:
+                self.data = self.decompressor.flush()
+            self.offset = 0
+            if not self.data:
+                if compressed:
+                    # Not enough input for any output yet.
+                    return self.read_byte()
+                raise ReplayError('Unexpected end of replay')
+        
+        byte = ord(self.data[self.offset])
+        self.offset += 1
+        return byte
+    
+    def read_varint(self):
+        number = 0
+        shift = 0
+        while True:
+            byte = self.read_byte()
+            number |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return number
+            shift += 7
+    
+    def read_signed(self):
+        number = self.read_varint()
+        if number & 1:
+            return -(number + 1) / 2
+        return number / 2
+    
+    def records(self):
+        """Yields the records as (tick, kind, data) tuples. For 'input'
+           records, data is a (car index, accel_dir, rot_dir) tuple. For
+           'keyframe' records it is a list with the quantized state of
+           every car, see set_keyframe(). The last record is ('end', None)."""
+        tick = 0
+        keyframe = [(0, 0, 0, 0)] * len(self.cars)
+        while True:
+            tick += self.read_varint()
+            kind = self.read_byte()
+            
+            if kind & RECORD_INPUT:
+                accel_dir, rot_dir = decode_controls(kind & 0x0f)
+                car = self.read_varint()
+                yield tick, 'input', (car, accel_dir, rot_dir)
+            elif kind == RECORD_KEYFRAME:
+                for i in range(len(self.cars)):
+                    keyframe[i] = tuple([previous + self.read_signed() for previous in keyframe[i]])
+                yield tick, 'keyframe', list(keyframe)
+            elif kind == RECORD_END:
+                yield tick, 'end', None
+                return
+            else:
+                raise ReplayError('Unknown record type %d' % kind)
+    
+    def close(self):
+        self.file.close()
+
+
+class ReplayPlayer(object):
+    """Drives the cars of a RaceSimulation from a replay. Set it as the
+       replay of the simulation, which then calls control() every step
+       instead of the control methods of the cars. The cars of the
+       simulation have to be set up like ReplayReader.cars describes."""
+    
+    def __init__(self, reader):
+        self.reader = reader
+        self.records = reader.records()
+        self.next_record = self.records.next()
+        
+        self.tick = 0
+        self.finished = False
+    
+    def control(self, simulation):
+        while not self.finished and self.next_record[0] <= self.tick:
+            tick, kind, data = self.next_record
+            
+            if kind == 'input':
+                car, accel_dir, rot_dir = data
+                simulation.cars[car].accel_dir = accel_dir
+                simulation.cars[car].rot_dir = rot_dir
+            elif kind == 'keyframe':
+                for car, values in zip(simulation.cars, data):
+                    set_keyframe(car, values)
+                simulation.fleet.gather()
+            else:
+                self.finished = True
+                break
+            
+            self.next_record = self.records.next()
+        
+        self.tick += 1
@@ -30,6 +30,7 @@ import pyglet
 
 import util
 import parts
+import atlas
 from game_state import state
 
 
@@ -710,7 +711,7 @@ class PartButton(Button):
         
         # Part image
         if part.image is not None:
-            img = pyglet.image.load('img/' + part.image)
+            img = atlas.manager.image(part.image)
         
             # The total height the label area of the button occupies.
             labels_height = name_label.element.y + name_label.height + label_top_margin
@@ -0,0 +1,869 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of RCr and copyright (C) Maik Gosenshuis and 
+# Jeroen Tietema 2008-09.
+#
+# RCr is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RCr is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RCr.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The rules of a race: car physics, the track overlay, checkpoints, laps
+and collisions. Nothing in here needs a window, sprites or sound, so races
+can also be run without a display (see the headless module)."""
+
+import os
+import math
+import ConfigParser
+
+import numpy
+
+from pyglet.image.codecs.png import PNGImageDecoder
+
+import cache
+import flowfield
+import parts
+import util
+
+
+# Convenience constants.
+FORWARD = RIGHT = 1
+REVERSE = LEFT = -1
+STILL = 0
+
+# Multipliers used to increase the effect of acceleration.
+ACCEL_MULTIPLIERS = {
+    FORWARD:    2000,
+    STILL:      0,
+    REVERSE:    1000
+}
+
+# The speed at which the car can rotate.
+ROTATION_SPEED = 150
+
+# The scale at which cars are drawn on the track.
+CAR_SCALE = 0.3
+
+CHECKPOINT_STAGE_TYPES = 3
+
+# The overlay image is a downscaled version of the track image. Every overlay
+# pixel covers OVERLAY_SCALE x OVERLAY_SCALE track pixels.
+OVERLAY_SCALE = 4
+
+# The friction factor used for everything outside the track.
+OFF_TRACK_FRICTION = 25 / 255.0
+
+# The computer drivers only steer when they are heading further off the flow
+# field than this many degrees.
+STEERING_TOLERANCE = 3
+
+# The computer drivers brake when they are heading further off the flow
+# field than this many degrees at the point they reach in BRAKING_TIME
+# seconds, while going faster than BRAKING_SPEED.
+BRAKING_ANGLE = 60
+BRAKING_TIME = 0.2
+BRAKING_SPEED = 200
+
+# The computer drivers reverse for REVERSE_STEPS steps when they could not
+# move for BLOCKED_STEPS steps in a row.
+BLOCKED_STEPS = 20
+REVERSE_STEPS = 60
+
+# Races with at least this many computer drivers steer them all at once
+# with ComputerDrivers. The batched lookups have a fixed cost per step that
+# only pays off for larger fields, see benchmarks/ai.py.
+MIN_BATCHED_DRIVERS = 12
+
+# Extra distance by which colliding cars are pushed apart.
+COLLISION_MARGIN = 0.5
+
+# The fraction of the closing speed that is kept when two cars collide: 0
+# makes them stick together, 1 makes them bounce off each other.
+COLLISION_RESTITUTION = 0.3
+
+# The duration of a single simulation step in seconds.
+TIMESTEP = 1 / 60.0
+
+# The maximum number of steps taken per advance() call. When the game can
+# not keep up, the race slows down instead of taking ever more steps.
+MAX_STEPS_PER_ADVANCE = 10
+
+
+class TrackSurface(object):
+    """The parts of a track that matter to the race rules: the starting
+       grid, the number of checkpoints and laps from tracks.ini, and the
+       overlay image with the path, checkpoint stages and friction."""
+    
+    def __init__(self, cup, track):
+        self.name = track
+        self.cup = cup
+        
+        self.overlay_data = None
+        self.path_plane = None
+        self.checkpoint_plane = None
+        self.friction_plane = None
+        self.flow_field = None
+        self.size = None
+        
+        # load the tracks config file
+        self.cp = cp = ConfigParser.ConfigParser()
+        cp.read(os.path.join('cups', cup, 'tracks.ini'))
+        # check if the track is there
+        if not cp.has_section(track):
+            raise Exception('Track not found')
+        
+        # set starting grid
+        self.start = []
+        for i in range(1, 9):
+            sx = cp.getint(track, 'start' + str(i) + 'x')
+            sy = cp.getint(track, 'start' + str(i) + 'y')
+            sr = cp.getint(track, 'start' + str(i) + 'r')
+            self.start.append(((sx, sy), sr))
+        
+        # set number of checkpoints
+        self.checkpoints = cp.getint(track, 'checkpoints')
+        
+        # set number of laps
+        self.laps = cp.getint(track, 'laps')
+    
+    def load_overlay(self):
+        '''Load the overlay'''
+        overlay_file = self.cp.get(self.name, 'overlay_image')
+        # set the encode explicitly otherwise we get in trouble with the image_data format
+        overlay_data = cache.load_image_array(os.path.join('cups', self.cup, overlay_file),
+            decoder=PNGImageDecoder())
+        # Keep the pixels in a single (height, width, RGBA) byte array instead
+        # of a list of ints; the rows are ordered top to bottom.
+        overlay_data = overlay_data[::-1]
+        self.compute_planes(overlay_data)
+        
+        # The flow field only depends on the overlay and the starting grid,
+        # so it is computed once and cached along with the overlay.
+        # The memory map is viewed as a plain array, as indexing a memmap
+        # instance is several times slower.
+        self.flow_field = numpy.asarray(cache.load_derived_array(
+            os.path.join('cups', self.cup, overlay_file), 'flow%d' % flowfield.VERSION,
+            self.compute_flow_field, depends=repr(self.start[0])))
+        
+        height, width = overlay_data.shape[:2]
+        self.size = (width * OVERLAY_SCALE, height * OVERLAY_SCALE)
+        
+        # The overlay counts as loaded once this is set, so set it last; the
+        # overlay may be loaded in a background thread.
+        self.overlay_data = overlay_data
+    
+    def compute_flow_field(self):
+        """Computes the flow field of the track from the path and friction
+           planes, see flowfield.compute_flow_field."""
+        try:
+            return flowfield.compute_flow_field(self.path_plane, self.friction_plane,
+                self.start[0], OVERLAY_SCALE)
+        except ValueError, e:
+            raise ValueError('Track %s of cup %s: %s' % (self.name, self.cup, e))
+    
+    def compute_planes(self, overlay_data):
+        """Derives the lookup planes used during a race from the overlay. The
+           red channel holds the path strength, the green channel the
+           checkpoint stages and the blue channel the friction."""
+        self.path_plane = numpy.ascontiguousarray(overlay_data[:,:,0])
+        
+        green = overlay_data[:,:,1]
+        self.checkpoint_plane = numpy.zeros(green.shape, dtype=numpy.int8)
+        self.checkpoint_plane[(10 < green) & (green < 100)] = 1
+        self.checkpoint_plane[green > 125] = 2
+        
+        self.friction_plane = overlay_data[:,:,2].astype(numpy.float32)
+        self.friction_plane /= 255.0
+    
+    def get_overlay_index(self, (x,y)):
+        """Returns the (row, column) index of the overlay cell at the
+           supplied track coordinates."""
+        overlay_y = int((self.size[1] - y) / OVERLAY_SCALE)
+        overlay_x = int(x / OVERLAY_SCALE)
+        return overlay_y - 1, overlay_x - 1
+    
+    def get_overlay_pixel(self, (x,y)):
+        """Returns the RGBA values of the overlay at the supplied track
+           coordinates."""
+        return self.overlay_data[self.get_overlay_index((x,y))]
+    
+    def sample_many(self, points):
+        """Samples the overlay at many track coordinates at once. Points
+           can be any sequence of (x, y) pairs, or an N x 2 array. Returns
+           a (friction, path, checkpoint_stage) tuple of arrays holding the
+           same values as the get_*_at methods would for each point."""
+        points = numpy.asarray(points, dtype=numpy.float64).reshape((-1, 2))
+        x, y = points[:,0], points[:,1]
+        
+        inside = (0 < x) & (x < self.size[0]) & (0 < y) & (y < self.size[1])
+        
+        # Points outside the track are clamped to a valid index; their values
+        # are replaced by the defaults below.
+        overlay_y = numpy.where(inside, (self.size[1] - y) / OVERLAY_SCALE, 0).astype(int)
+        overlay_x = numpy.where(inside, x / OVERLAY_SCALE, 0).astype(int)
+        index = (overlay_y - 1, overlay_x - 1)
+        
+        friction = numpy.where(inside, self.friction_plane[index], OFF_TRACK_FRICTION)
+        path = numpy.where(inside, self.path_plane[index], 0)
+        checkpoint_stage = numpy.where(inside, self.checkpoint_plane[index], 0)
+        
+        return friction, path, checkpoint_stage
+    
+    def get_friction_at(self, (x,y)):
+        """Returns the friction of the terrain as a factor between 0 and 1."""
+        if 0 < x < self.size[0] and 0 < y < self.size[1]:
+            return self.friction_plane[self.get_overlay_index((x,y))]
+        return OFF_TRACK_FRICTION
+    
+    def get_path_at(self, (x,y)):
+        if 0 < x < self.size[0] and 0 < y < self.size[1]:
+            return self.path_plane[self.get_overlay_index((x,y))]
+        return 0
+    
+    def get_checkpoint_stage_at(self, (x,y)):
+        if 0 < x < self.size[0] and 0 < y < self.size[1]:
+            return self.checkpoint_plane[self.get_overlay_index((x,y))]
+        return 0
+    
+    def get_flow_at(self, (x,y)):
+        """Returns the (heading, distance to the centerline) the flow field
+           holds for the supplied track coordinates. The heading is NaN
+           where the field has no direction."""
+        if 0 < x < self.size[0] and 0 < y < self.size[1]:
+            row, column = self.get_overlay_index((x,y))
+            return self.flow_field[row / flowfield.FLOW_CELL, column / flowfield.FLOW_CELL]
+        return (numpy.nan, numpy.inf)
+    
+    def get_flow_many(self, x, y):
+        """Looks up the flow field at many track coordinates at once, like
+           get_flow_at. X and y are arrays of coordinates. Returns a
+           (heading, distance) tuple of arrays."""
+        inside = (0 < x) & (x < self.size[0]) & (0 < y) & (y < self.size[1])
+        
+        # Points outside the track are clamped to a valid index; their values
+        # are replaced below.
+        row = numpy.where(inside, (self.size[1] - y) / OVERLAY_SCALE, 0).astype(int) - 1
+        column = numpy.where(inside, x / OVERLAY_SCALE, 0).astype(int) - 1
+        flow = self.flow_field[row / flowfield.FLOW_CELL, column / flowfield.FLOW_CELL]
+        
+        outside = ~inside
+        flow[outside] = (numpy.nan, numpy.inf)
+        return flow[:,0], flow[:,1]
+    
+    def get_start(self):
+        return self.start
+    
+    def get_checkpoints(self):
+        return self.checkpoints
+    
+    def get_size(self):
+        return self.size
+    
+    def get_laps(self):
+        return self.laps
+
+
+class CarPhysics(object):
+    """The physical behaviour of a car. Classes mixing this in need body,
+       engine and tyres parts, and x, y and rotation attributes."""
+    
+    # Cars driven by the computer follow the path. In races with many of
+    # them, they are all steered at once by ComputerDrivers instead of by
+    # control().
+    driven_by_computer = False
+    
+    def reset(self, rotation=0):
+        """Resets the physical state of the car."""
+        self.scale = CAR_SCALE
+        
+        self.speed = 0
+        self.rotation = rotation
+        
+        self.stopping = False
+        
+        # The direction in which we are accelerating.
+        self.accel_dir = 0
+        
+        # The direction in which we are rotating.
+        self.rot_dir = 0
+        
+        # The number of steps the computer driver could not move and is
+        # still reversing, the direction it is turning in while reversing
+        # and its position at the previous step.
+        self.blocked = 0
+        self.reversing = 0
+        self.turn = 0
+        self.last_position = None
+    
+    def set_part_dependant_properties(self):
+        """Sets properties that depend on the car's parts. These mainly
+           relate to physical properties."""
+        self.friction_multiplier = (1.0/self.mass) * self.grip
+        
+        # Multiplier used in calculation of maximum speed and acceleration.
+        self.accel_multiplier = self.friction_multiplier * self.power
+        
+        # Braking depends on the friction, as well as the mass of the car.
+        self.brake_multiplier = self.friction_multiplier * (10 - self.mass)
+        
+        # recalculate the size
+        self.width, self.height = self.body.size
+    
+    def control(self, simulation):
+        """Sets the accel_dir and rot_dir of the car before every step of
+           the simulation. Cars without a driver do nothing. The physics of
+           all cars in a race are updated together by a CarFleet."""
+        pass
+    
+    def follow_path(self, surface):
+        """Steers towards the heading of the flow field below the car, and
+           accelerates. Cars that got stuck against a wall reverse for a
+           while, turning their nose towards the heading."""
+        heading, distance = surface.get_flow_at((self.x, self.y))
+        
+        # The difference between -180 and 180 degrees.
+        difference = (heading - self.rotation + 180) % 360 - 180
+        
+        position = (self.x, self.y)
+        if position == self.last_position and self.accel_dir != 0 and not self.reversing:
+            self.blocked += 1
+        else:
+            self.blocked = 0
+        self.last_position = position
+        
+        if self.blocked >= BLOCKED_STEPS:
+            self.blocked = 0
+            self.reversing = REVERSE_STEPS
+            self.turn = 1 if difference > 0 else -1
+        
+        if self.reversing:
+            self.reversing -= 1
+            self.accel_dir = -1
+            # Driving backwards turns the car the other way.
+            if self.speed < 0:
+                self.rot_dir = -self.turn
+            else:
+                self.rot_dir = self.turn
+            return
+        
+        if abs(difference) > 180 - STEERING_TOLERANCE * 10 and self.rot_dir != 0:
+            # Keep turning the same way to turn around, instead of changing
+            # direction every step.
+            pass
+        elif difference < -STEERING_TOLERANCE:
+            self.rot_dir = -1
+        elif difference > STEERING_TOLERANCE:
+            self.rot_dir = 1
+        else:
+            self.rot_dir = 0
+        
+        # Brake for sharp corners ahead.
+        r = math.radians(self.rotation)
+        ahead = self.speed * BRAKING_TIME
+        heading_ahead, distance = surface.get_flow_at((self.x + math.sin(r) * ahead,
+            self.y + math.cos(r) * ahead))
+        difference_ahead = (heading_ahead - self.rotation + 180) % 360 - 180
+        if abs(difference_ahead) > BRAKING_ANGLE and self.speed > BRAKING_SPEED:
+            self.accel_dir = -1
+        else:
+            self.accel_dir = 1
+    
+    def disable_controls(self):
+        pass
+    
+    def stop(self):
+        self.disable_controls()
+        self.accel_dir = -1
+        self.stopping = True
+    
+    mass    = property(lambda self: self.body.mass)
+    power   = property(lambda self: self.engine.power)
+    grip    = property(lambda self: self.tyres.grip)
+    
+    def get_bounding_radius(self):
+        """Returns the radius of the circle around the car's center that
+           contains the whole car, whatever its rotation."""
+        return math.hypot(self.width, self.height) * self.scale / 2
+    
+    def get_box(self):
+        """Returns the car's outline as a util.OrientedBox, centered on the
+           car and turned by its rotation."""
+        return util.OrientedBox(self.x, self.y, math.radians(self.rotation),
+            self.width * self.scale / 2, self.height * self.scale / 2)
+
+
+class CarFleet(object):
+    """Holds the physical state of all cars in a race in arrays, so the
+       speed, rotation and position of every car can be updated at once.
+       The car objects only mirror the results."""
+    
+    def __init__(self, cars):
+        self.cars = cars
+        
+        self.accel_multiplier = numpy.array([car.accel_multiplier for car in cars], dtype=numpy.float64)
+        self.brake_multiplier = numpy.array([car.brake_multiplier for car in cars], dtype=numpy.float64)
+        self.friction_multiplier = numpy.array([car.friction_multiplier for car in cars], dtype=numpy.float64)
+        
+        self.x = numpy.zeros(len(cars))
+        self.y = numpy.zeros(len(cars))
+        self.rotation = numpy.zeros(len(cars))
+        self.speed = numpy.zeros(len(cars))
+        self.accel_dir = numpy.zeros(len(cars))
+        self.rot_dir = numpy.zeros(len(cars))
+        self.stopping = numpy.zeros(len(cars), dtype=bool)
+        
+        self.gather()
+    
+    def gather(self):
+        """Copies the state of the car objects into the arrays."""
+        for i, car in enumerate(self.cars):
+            self.x[i] = car.x
+            self.y[i] = car.y
+            self.rotation[i] = car.rotation
+            self.speed[i] = car.speed
+        self.gather_controls()
+    
+    def gather_controls(self):
+        """Copies the controls of the car objects into the arrays."""
+        for i, car in enumerate(self.cars):
+            self.accel_dir[i] = car.accel_dir
+            self.rot_dir[i] = car.rot_dir
+            self.stopping[i] = car.stopping
+    
+    def scatter(self):
+        """Copies the arrays back into the car objects."""
+        for i, car in enumerate(self.cars):
+            car.x = float(self.x[i])
+            car.y = float(self.y[i])
+            car.rotation = float(self.rotation[i])
+            car.speed = float(self.speed[i])
+            car.accel_dir = int(self.accel_dir[i])
+    
+    def move(self, dt, surface):
+        """Updates the speed, rotation and position of every car, based on
+           the terrain below them. Returns the checkpoint stages at the new
+           positions."""
+        friction, path, checkpoint_stage = surface.sample_many(numpy.column_stack((self.x, self.y)))
+        
+        self.speed = self.calculate_speed(dt, friction)
+        
+        rot_factor = numpy.minimum(1, numpy.abs(self.speed) / 200)
+        self.rotation = numpy.mod(self.rotation + rot_factor * ROTATION_SPEED * self.rot_dir * numpy.sign(self.speed) * dt, 360)
+        
+        r = numpy.radians(self.rotation)
+        s = dt * self.speed
+        
+        target_x = self.x + numpy.sin(r) * s
+        target_y = self.y + numpy.cos(r) * s
+        
+        # Cars can not drive onto terrain without any friction.
+        target_friction, path, target_checkpoint_stage = surface.sample_many(
+            numpy.column_stack((target_x, target_y)))
+        valid = target_friction > 0
+        self.x = numpy.where(valid, target_x, self.x)
+        self.y = numpy.where(valid, target_y, self.y)
+        
+        return numpy.where(valid, target_checkpoint_stage, checkpoint_stage)
+    
+    def calculate_speed(self, dt, friction):
+        """Calculates the new speed of every car based on its current speed,
+           the amount of time passed and physical properties like the
+           friction and the car's mass. See CarPhysics for the rules."""
+        speed = self.speed
+        
+        accel_sig = numpy.sign(self.accel_dir)
+        speed_sig = numpy.sign(speed)
+        
+        # Cars accelerating in the direction they are heading, or standing
+        # still. Standing still without accelerating keeps the speed at 0.
+        accelerating = (accel_sig == speed_sig) | (speed_sig == 0)
+        
+        direction_multiplier = numpy.where(accel_sig > 0, ACCEL_MULTIPLIERS[FORWARD],
+            numpy.where(accel_sig < 0, ACCEL_MULTIPLIERS[REVERSE], ACCEL_MULTIPLIERS[STILL]))
+        speed_multiplier = self.accel_multiplier * self.accel_dir * direction_multiplier * friction
+        
+        accelerated = speed + speed_multiplier * dt
+        accelerated = numpy.where(numpy.abs(accelerated) > numpy.abs(speed_multiplier),
+            speed_multiplier, accelerated)
+        
+        # The other cars are slowed down by the friction, or by braking.
+        slow_down_multiplier = numpy.where(accel_sig == 0, self.friction_multiplier,
+            numpy.maximum(self.friction_multiplier, self.brake_multiplier * numpy.abs(self.accel_dir)))
+        
+        slowed = speed - speed_sig * slow_down_multiplier * 2000 * friction * dt
+        halted = ~accelerating & (slowed * speed_sig < 0)
+        slowed = numpy.where(halted, 0, slowed)
+        
+        self.accel_dir = numpy.where(halted & self.stopping, 0, self.accel_dir)
+        
+        return numpy.where(accelerating, accelerated, slowed)
+
+
+class ComputerDrivers(object):
+    """Steers all cars of a CarFleet that are driven by the computer at
+       once. Makes the same decisions as CarPhysics.follow_path, looking up
+       the flow field for all cars in a single gather."""
+    
+    def __init__(self, fleet):
+        self.fleet = fleet
+        self.indices = numpy.array([i for i, car in enumerate(fleet.cars)
+            if car.driven_by_computer], dtype=int)
+        self.cars = [fleet.cars[i] for i in self.indices]
+        
+        # See CarPhysics.reset.
+        self.blocked = numpy.zeros(len(self.cars), dtype=int)
+        self.reversing = numpy.zeros(len(self.cars), dtype=int)
+        self.turn = numpy.zeros(len(self.cars), dtype=int)
+        self.last_x = numpy.empty(len(self.cars))
+        self.last_x[...] = numpy.nan
+        self.last_y = self.last_x.copy()
+    
+    def control(self, surface):
+        """Sets the accel_dir and rot_dir of the cars that are not
+           stopping."""
+        if not self.cars:
+            return
+        
+        fleet = self.fleet
+        x = fleet.x[self.indices]
+        y = fleet.y[self.indices]
+        rotation = fleet.rotation[self.indices]
+        speed = fleet.speed[self.indices]
+        accel_dir = fleet.accel_dir[self.indices]
+        rot_dir = fleet.rot_dir[self.indices]
+        # Cars that finished stopped during the previous step, so the fleet
+        # does not know yet.
+        driving = numpy.array([not car.stopping for car in self.cars])
+        
+        # The flow below the cars, and ahead of them to brake for corners.
+        r = numpy.radians(rotation)
+        ahead = speed * BRAKING_TIME
+        heading, distance = surface.get_flow_many(
+            numpy.concatenate((x, x + numpy.sin(r) * ahead)),
+            numpy.concatenate((y, y + numpy.cos(r) * ahead)))
+        
+        # The differences between -180 and 180 degrees.
+        difference = (heading[:len(x)] - rotation + 180) % 360 - 180
+        difference_ahead = (heading[len(x):] - rotation + 180) % 360 - 180
+        
+        blocked = (x == self.last_x) & (y == self.last_y) & (accel_dir != 0) & (self.reversing == 0)
+        self.blocked = numpy.where(driving & blocked, self.blocked + 1,
+            numpy.where(driving, 0, self.blocked))
+        self.last_x = numpy.where(driving, x, self.last_x)
+        self.last_y = numpy.where(driving, y, self.last_y)
+        
+        start = self.blocked >= BLOCKED_STEPS
+        self.blocked[start] = 0
+        self.reversing[start] = REVERSE_STEPS
+        self.turn[start] = numpy.where(difference[start] > 0, 1, -1)
+        
+        reversing = driving & (self.reversing > 0)
+        self.reversing[reversing] -= 1
+        
+        new_rot_dir = numpy.where(difference < -STEERING_TOLERANCE, -1,
+            numpy.where(difference > STEERING_TOLERANCE, 1, 0))
+        turning_around = (numpy.abs(difference) > 180 - STEERING_TOLERANCE * 10) & (rot_dir != 0)
+        new_rot_dir = numpy.where(turning_around, rot_dir, new_rot_dir)
+        new_rot_dir = numpy.where(reversing, numpy.where(speed < 0, -self.turn, self.turn),
+            new_rot_dir)
+        
+        braking = (numpy.abs(difference_ahead) > BRAKING_ANGLE) & (speed > BRAKING_SPEED)
+        new_accel_dir = numpy.where(braking | reversing, -1, 1)
+        
+        for i in numpy.nonzero(driving)[0]:
+            car = self.cars[i]
+            car.accel_dir = int(new_accel_dir[i])
+            car.rot_dir = int(new_rot_dir[i])
+
+
+class SimulatedCar(CarPhysics):
+    """A car without sprites or sound, driven by the computer."""
+    
+    driven_by_computer = True
+    
+    def __init__(self, body, engine, tyres, name=None):
+        """Parts can be specified as string identifiers or Part
+           instances."""
+        for part_type, part in (('body', body), ('engine', engine), ('tyres', tyres)):
+            if isinstance(part, str):
+                part = parts.manager.get_part_by_id(part_type, part)
+            setattr(self, part_type, part)
+        
+        if name is None:
+            name = '%s/%s/%s' % (self.body, self.engine, self.tyres)
+        self.name = name
+        
+        self.x = 0
+        self.y = 0
+        
+        self.set_part_dependant_properties()
+        self.reset()
+    
+    def __repr__(self):
+        return '<SimulatedCar %s>' % self.name
+    
+    def _get_position(self):
+        return (self.x, self.y)
+    def _set_position(self, (x, y)):
+        self.x = x
+        self.y = y
+    position = property(_get_position, _set_position)
+    
+    def control(self, simulation):
+        if not self.stopping:
+            self.follow_path(simulation.surface)
+
+
+class RaceSimulation(object):
+    """Runs a race on a TrackSurface in steps of a fixed duration. The cars
+       can be any objects mixing in CarPhysics."""
+    
+    def __init__(self, surface, cars, timestep=TIMESTEP):
+        self.surface = surface
+        self.cars = cars
+        self.timestep = timestep
+        
+        # The race time simulated so far, and the real time that was not
+        # simulated yet in advance().
+        self.time = 0
+        self.time_left = 0
+        
+        self.results = []
+        self.stats = {}
+        
+        # define start grid
+        grid = surface.get_start()
+        for i, car in enumerate(self.cars):
+            car.reset()
+            car.position = grid[i][0]
+            car.rotation = grid[i][1]
+            
+            self.stats[car] = Stats(car)
+        
+        self.fleet = CarFleet(self.cars)
+        
+        self.drivers = None
+        if len([car for car in cars if car.driven_by_computer]) >= MIN_BATCHED_DRIVERS:
+            self.drivers = ComputerDrivers(self.fleet)
+        
+        # A ReplayRecorder that records the controls of the cars, and a
+        # ReplayPlayer that controls the cars instead of their drivers.
+        self.recorder = None
+        self.replay = None
+        
+        # A GhostRecorder that samples the player's car after every step.
+        self.ghost_recorder = None
+    
+    def advance(self, dt):
+        """Simulates as many whole steps as fit in the supplied amount of
+           real time, carrying over the remainder to the next call. Returns
+           the number of steps taken."""
+        self.time_left += dt
+        
+        steps = min(int(self.time_left / self.timestep), MAX_STEPS_PER_ADVANCE)
+        for i in range(steps):
+            self.step()
+        
+        self.time_left = min(self.time_left - steps * self.timestep, self.timestep)
+        return steps
+    
+    def run(self, time_limit=None):
+        """Steps until every car finished, or until the race took longer
+           than the time limit (in seconds of race time). Returns the
+           results, completed like autocomplete_results does."""
+        while not self.finished and (time_limit is None or self.time < time_limit):
+            self.step()
+        
+        self.autocomplete_results()
+        return self.results
+    
+    def step(self):
+        """Advances the race by a single timestep."""
+        dt = self.timestep
+        
+        if self.replay is not None:
+            self.replay.control(self)
+        else:
+            for car in self.cars:
+                if self.drivers is None or not car.driven_by_computer:
+                    car.control(self)
+            if self.drivers is not None:
+                self.drivers.control(self.surface)
+        
+        if self.recorder is not None:
+            self.recorder.record(self)
+        
+        self.fleet.gather_controls()
+        checkpoint_stages = self.fleet.move(dt, self.surface)
+        self.fleet.scatter()
+        
+        for car, checkpoint_stage in zip(self.cars, checkpoint_stages):
+            self.update_stats(self.stats[car], checkpoint_stage, dt)
+        
+        if self.collide_cars():
+            self.fleet.gather()
+        
+        if self.ghost_recorder is not None:
+            self.ghost_recorder.record(self)
+        
+        self.time += dt
+    
+    def update_stats(self, stats, checkpoint_stage, dt):
+        """Updates the checkpoints, lap times and laps of a car."""
+        # update checkpoints
+        next_checkpoint_stage = (stats.last_checkpoint_stage + 1) % CHECKPOINT_STAGE_TYPES
+        
+        if checkpoint_stage == next_checkpoint_stage:
+            # Car changed checkpoint stage and is driving in the right
+            # direction.
+            if checkpoint_stage == 2:
+                stats.checkpoints += 1
+        elif checkpoint_stage <> stats.last_checkpoint_stage and stats.last_checkpoint_stage > -1:
+            # Car changed checkpoint stage and is driving the wrong way.
+            if checkpoint_stage == 1:
+                stats.checkpoints -= 1
+        
+        stats.last_checkpoint_stage = checkpoint_stage
+        
+        stats.current_lap_time += dt
+        
+        # update laps
+        if stats.checkpoints == self.surface.get_checkpoints():
+            # At finish.
+            stats.checkpoints = 0
+            
+            # Store the lap time and reset the current lap time.
+            stats.lap_times.append(stats.current_lap_time)
+            stats.current_lap_time = 0
+            
+            if stats.laps >= self.surface.get_laps():
+                # Stop the car, disabling any controls in the process.
+                stats.car.stop()
+                
+                stats.finished = True
+                self.add_result(stats)
+            else:
+                stats.laps += 1
+    
+    def collide_cars(self):
+        """Separates the cars that overlap. Returns whether any cars
+           collided."""
+        # Only cars whose bounding circles overlap can collide, so find those
+        # pairs first and only test their outlines.
+        circles = [(car.x, car.y, car.get_bounding_radius()) for car in self.cars]
+        boxes = {}
+        collided = False
+        for i, j in util.find_overlapping_circles(circles):
+            for k in (i, j):
+                if k not in boxes:
+                    boxes[k] = self.cars[k].get_box()
+            penetration = util.obb_penetration(boxes[i], boxes[j])
+            if penetration is not None:
+                self.resolve_collision(self.cars[i], self.cars[j], penetration)
+                
+                # The cars moved, so their boxes have to be rebuilt when they
+                # are tested against another car.
+                del boxes[i], boxes[j]
+                collided = True
+        
+        return collided
+    
+    def resolve_collision(self, car1, car2, (depth, axis_x, axis_y)):
+        """Pushes two colliding cars apart along the minimum translation
+           vector, with car2 moving along the axis and car1 against it. The
+           lighter car is pushed further. The speed of both cars along the
+           axis is exchanged like in a partly elastic collision."""
+        total_mass = car1.mass + car2.mass
+        
+        # Add a small margin, so the cars no longer touch afterwards.
+        depth += COLLISION_MARGIN
+        share1 = depth * car2.mass / total_mass
+        share2 = depth * car1.mass / total_mass
+        
+        car1.x -= axis_x * share1
+        car1.y -= axis_y * share1
+        car2.x += axis_x * share2
+        car2.y += axis_y * share2
+        
+        # Cars can only move in the direction they are heading, so work out
+        # the velocity vectors, apply the impulse to those and project the
+        # results back onto the headings.
+        heading1 = math.radians(car1.rotation)
+        heading2 = math.radians(car2.rotation)
+        dir1 = (math.sin(heading1), math.cos(heading1))
+        dir2 = (math.sin(heading2), math.cos(heading2))
+        
+        closing_speed = ((dir2[0] * car2.speed - dir1[0] * car1.speed) * axis_x +
+            (dir2[1] * car2.speed - dir1[1] * car1.speed) * axis_y)
+        if closing_speed >= 0:
+            # Already moving apart.
+            return
+        
+        impulse = -(1 + COLLISION_RESTITUTION) * closing_speed * car1.mass * car2.mass / total_mass
+        
+        car1.speed -= impulse / car1.mass * (dir1[0] * axis_x + dir1[1] * axis_y)
+        car2.speed += impulse / car2.mass * (dir2[0] * axis_x + dir2[1] * axis_y)
+    
+    def add_result(self, stats):
+        # Cars that finish on the same step have equal times, so compare
+        # the instances themselves.
+        assert not any(result is stats for result in self.results)
+        
+        self.results.append(stats)
+    
+    def autocomplete_results(self):
+        """Automatically fills in a custom time for all cars that did not
+           finish yet."""
+        for stats in self.stats.values():
+            if not stats.finished:
+                assert not any(result is stats for result in self.results)
+                
+                if self.results:
+                    stats.total_time = self.results[-1].total_time + 30
+                else:
+                    stats.total_time = self.time + 30
+                stats.finished = True
+                self.results.append(stats)
+    
+    def _is_finished(self):
+        for stats in self.stats.values():
+            if not stats.finished:
+                return False
+        return True
+    finished = property(_is_finished, doc="True once every car finished.")
+
+
+class Stats():
+    def __init__(self, car):
+        self.car = car
+        
+        # Timer for the current lap.
+        self.current_lap_time = 0
+        
+        # A list of lap times.
+        self.lap_times = []
+        
+        # The lap the car is currently in.
+        self.laps = 1
+        
+        # The last checkpoint stage the car was in.
+        self.last_checkpoint_stage = -1
+        
+        # The number of check points passed since the finish. Set to -1
+        # initially to compensate for a starting grid before the finish
+        # line.
+        self.checkpoints = -1
+        
+        # Reflects if this car finished the race.
+        self.finished = False
+    
+    total_time = property(lambda self: sum(self.lap_times),
+        doc="Returns the sum of all the lap times.")
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of RCr and copyright (C) Maik Gosenshuis and 
+# Jeroen Tietema 2008-09.
+#
+# RCr is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RCr is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RCr.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of recording races and playing them back.
+
+Run from the root directory of the game:
+
+    python tests/test_replay.py
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.getcwd())
+
+import headless
+import pyglet.resource
+from simulation import SimulatedCar, RaceSimulation
+from replay import ReplayRecorder, ReplayReader, ReplayPlayer
+
+
+# Relative resource paths are looked up next to the script, which is not in
+# the root directory of the game.
+pyglet.resource.path = [os.path.abspath(path) for path in pyglet.resource.path]
+pyglet.resource.reindex()
+
+# More cars than the starting grid of a track holds; the extra cars start
+# behind the grid.
+NUM_CARS = 20
+
+STEPS = 400
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'test.rcr')
+    
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+    
+    def make_simulation(self):
+        surface = headless.load_surface('garden', 'garden1')
+        grid = surface.start
+        surface.start = [((x, y - 60 * (i / len(grid))), rotation)
+            for i, ((x, y), rotation) in enumerate(grid * (NUM_CARS / len(grid) + 1))]
+        cars = [SimulatedCar(*headless.DEFAULT_CAR) for i in range(NUM_CARS)]
+        return RaceSimulation(surface, cars)
+    
+    def test_many_cars(self):
+        simulation = self.make_simulation()
+        simulation.recorder = ReplayRecorder(self.filename, simulation, focus=NUM_CARS - 1)
+        for i in range(STEPS):
+            simulation.step()
+        simulation.recorder.close()
+        recorded = [(car.x, car.y, car.rotation, car.speed) for car in simulation.cars]
+        
+        reader = ReplayReader(self.filename)
+        try:
+            self.assertEqual(len(reader.cars), NUM_CARS)
+            self.assertEqual(reader.focus, NUM_CARS - 1)
+            
+            simulation = self.make_simulation()
+            simulation.replay = ReplayPlayer(reader)
+            for i in range(STEPS):
+                simulation.step()
+        finally:
+            reader.close()
+        played = [(car.x, car.y, car.rotation, car.speed) for car in simulation.cars]
+        
+        self.assertEqual(played, recorded)
+
+
+if __name__ == '__main__':
+    unittest.main()
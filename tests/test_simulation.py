@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of RCr and copyright (C) Maik Gosenshuis and 
+# Jeroen Tietema 2008-09.
+#
+# RCr is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RCr is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RCr.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the headless race simulation.
+
+Run from the root directory of the game:
+
+    python tests/test_simulation.py
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.getcwd())
+
+import headless
+import pyglet.resource
+from simulation import TrackSurface, SimulatedCar, RaceSimulation
+
+
+# Relative resource paths are looked up next to the script, which is not in
+# the root directory of the game.
+pyglet.resource.path = [os.path.abspath(path) for path in pyglet.resource.path]
+pyglet.resource.reindex()
+
+
+class ResultsTest(unittest.TestCase):
+    def setUp(self):
+        surface = headless.load_surface('garden', 'garden1')
+        self.cars = [SimulatedCar(*headless.DEFAULT_CAR) for i in range(3)]
+        self.simulation = RaceSimulation(surface, self.cars)
+    
+    def finish(self, car):
+        """Puts a car on the last lap, one checkpoint from the finish, and
+           lets it pass the finish in the current step."""
+        simulation = self.simulation
+        stats = simulation.stats[car]
+        stats.laps = simulation.surface.get_laps()
+        stats.lap_times = [10.0] * (stats.laps - 1)
+        stats.checkpoints = simulation.surface.get_checkpoints()
+        simulation.update_stats(stats, stats.last_checkpoint_stage, simulation.timestep)
+        return stats
+    
+    def test_finish_on_same_step(self):
+        first = self.finish(self.cars[0])
+        second = self.finish(self.cars[1])
+        self.assertEqual(first.total_time, second.total_time)
+        
+        results = self.simulation.results
+        self.assertEqual(len(results), 2)
+        self.assertTrue(results[0] is first and results[1] is second)
+        self.assertEqual(results.index(second), 1)
+        
+        self.simulation.autocomplete_results()
+        self.assertEqual(len(results), 3)
+        self.assertTrue(results[2] is self.simulation.stats[self.cars[2]])
+
+
+class FlowFieldTest(unittest.TestCase):
+    def test_start_off_track(self):
+        surface = TrackSurface('garden', 'garden1')
+        # The corner of the track, on the grass.
+        surface.start[0] = ((8, 8), surface.start[0][1])
+        try:
+            surface.load_overlay()
+        except ValueError, e:
+            self.assertTrue('garden1' in str(e) and 'closed loop' in str(e))
+        else:
+            self.fail('ValueError not raised')
+
+
+if __name__ == '__main__':
+    unittest.main()
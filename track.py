@@ -17,15 +17,39 @@
 # along with RCr.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import ConfigParser
+import sys
+import math
+import time
+import threading
+import Queue
 
 import cocos
 import pyglet
 import pyglet.info
-from pyglet.image.codecs.png import PNGImageDecoder
 
+import cache
+from simulation import TrackSurface
 
-CHECKPOINT_STAGE_TYPES = 3
+
+# The time in seconds the main thread may spend per frame on uploading
+# partitions while loading a track.
+UPLOAD_TIME_BUDGET = 0.02
+
+# Partitions within this many pixels of the visible area are drawn as well.
+CULL_MARGIN = 50
+
+# Partitions within this many pixels of the visible area are uploaded ahead
+# of time, so they are ready once they scroll into view.
+PREFETCH_MARGIN = 500
+
+# The default amount of video memory in bytes the partition textures of a
+# track may use. Can be overridden per track with the texture_budget option
+# (in megabytes) in tracks.ini.
+TEXTURE_BUDGET = 64 * 1024 * 1024
+
+# The number of sliced partitions the loader keeps ready for uploading.
+# Each partition takes TEXTURE_SIZE * TEXTURE_SIZE * 4 bytes.
+LOADER_QUEUE_SIZE = 4
 
 
 class Track(cocos.layer.Layer):
@@ -40,34 +64,36 @@ class Track(cocos.layer.Layer):
         self.overlay_data = None
         self.size = None
         self.partition_list = None
+        self.preload_list = None
+        self.partitions_left = None
+        self.loaded_partitions = set()
+        self.partition_sprites = {}
+        self.loader = None
         
-        # load the tracks config file
-        self.cp = cp = ConfigParser.ConfigParser()
-        cp.read(os.path.join('cups', cup, 'tracks.ini'))
-        # check if the track is there
-        if not cp.has_section(track):
-            raise Exception('Track not found')
-        
-        # set starting grid
-        self.start = []
-        for i in range(1, 9):
-            sx = cp.getint(track, 'start' + str(i) + 'x')
-            sy = cp.getint(track, 'start' + str(i) + 'y')
-            sr = cp.getint(track, 'start' + str(i) + 'r')
-            self.start.append(((sx, sy), sr))
+        # The number of partitions drawn and skipped in the last frame.
+        self.drawn_partitions = 0
+        self.culled_partitions = 0
         
-        # set number of checkpoints
-        self.checkpoints = cp.getint(track, 'checkpoints')
+        # The starting grid, checkpoints, laps and overlay, which is all the
+        # race rules need to know about the track.
+        self.surface = TrackSurface(cup, track)
+        self.cp = cp = self.surface.cp
         
-        # set number of laps
-        self.laps = cp.getint(track, 'laps')
+        # set the video memory available for the partitions
+        texture_budget = TEXTURE_BUDGET
+        if cp.has_option(track, 'texture_budget'):
+            texture_budget = cp.getint(track, 'texture_budget') * 1024 * 1024
+        partition_bytes = self.TEXTURE_SIZE * self.TEXTURE_SIZE * 4
+        self.residency = TextureResidency(max(1, texture_budget / partition_bytes))
         
     def load_images(self):
         '''load the track image(s)'''
         track_image_name = self.cp.get(self.name, 'track_image')
-        self.track_image = pyglet.image.load(os.path.join('cups', self.cup,track_image_name))
+        # The pixels are kept as a (height, width, RGBA) array, which is
+        # memory-mapped from the disk cache when the track was loaded before.
+        self.track_image = cache.load_image_array(os.path.join('cups', self.cup, track_image_name))
         
-        width, height = self.track_image.width, self.track_image.height
+        height, width = self.track_image.shape[:2]
         
         # partition the image in multiple sprites
         number_x = width / self.TEXTURE_SIZE
@@ -77,27 +103,203 @@ class Track(cocos.layer.Layer):
             for y in range(number_y):
                 self.partition_list.append((x * self.TEXTURE_SIZE, y * self.TEXTURE_SIZE))
         
+        # Load the partitions around the starting grid first, so a race can
+        # start before the rest of the track is available.
+        self.partition_list.sort(key=self.get_distance_to_start)
+        
+        # Only the partitions that fit in the texture budget are loaded up
+        # front; the others are uploaded when they come near the view.
+        self.preload_list = self.partition_list[:self.residency.capacity]
+        
+        self.partitions_left = len(self.preload_list)
         self.size = (width, height)
     
     def load_overlay(self):
         '''Load the overlay'''
-        overlay_file = self.cp.get(self.name, 'overlay_image')
-        # set the encode explicitly otherwise we get in trouble with the image_data format
-        overlay_image = pyglet.image.load(os.path.join('cups', self.cup, overlay_file), decoder=PNGImageDecoder())
-        image_data = overlay_image.get_image_data()
-        data = image_data.get_data('RGBA', image_data.pitch)
-        self.overlay_data = map(ord, list(data))
-    
-    def load_partitions(self):
-        x, y = self.partition_list.pop(0)
-        part_image = self.track_image.get_region(x, y, self.TEXTURE_SIZE, self.TEXTURE_SIZE)
+        self.surface.load_overlay()
+        
+        # The overlay counts as loaded once this is set.
+        self.overlay_data = self.surface.overlay_data
+    
+    def start_loading(self):
+        """Starts loading the track images in a background thread. The
+           tiles are uploaded to the video card by calling load_partitions
+           repeatedly from the main thread."""
+        self.loader = TrackLoader(self)
+        self.loader.start()
+    
+    def slice_partition(self, (x, y)):
+        """Returns the pixels of the partition with its lower left corner at
+           the supplied position as a string of RGBA bytes."""
+        pixels = self.track_image[y:y + self.TEXTURE_SIZE, x:x + self.TEXTURE_SIZE]
+        return pixels.tostring()
+    
+    def add_partition(self, (x, y), pixels):
+        """Uploads the pixels of a partition and adds them as a sprite."""
+        part_image = pyglet.image.ImageData(self.TEXTURE_SIZE, self.TEXTURE_SIZE,
+            'RGBA', pixels, self.TEXTURE_SIZE * 4)
         sprite = cocos.sprite.Sprite(part_image)
         sprite.position = (x + self.TEXTURE_SIZE / 2, y + self.TEXTURE_SIZE / 2)
         self.add(sprite)
-        partitions_left = len(self.partition_list)
-        if partitions_left == 0:
+        self.loaded_partitions.add((x, y))
+        self.partition_sprites[(x, y)] = sprite
+        self.residency.touch((x, y))
+    
+    def remove_partition(self, position):
+        """Removes the sprite of a partition, releasing its texture."""
+        sprite = self.partition_sprites.pop(position)
+        self.remove(sprite)
+        sprite.delete()
+        self.loaded_partitions.discard(position)
+        self.residency.remove(position)
+    
+    def load_partitions(self, time_budget=UPLOAD_TIME_BUDGET):
+        """Uploads the partitions the loader has prepared so far, until the
+           time budget (in seconds) is used up. Returns the number of
+           partitions left, or None while the track image is being
+           decoded."""
+        start = time.time()
+        while True:
+            try:
+                position, pixels = self.loader.ready.get_nowait()
+            except Queue.Empty:
+                break
+            # The partition may have been uploaded on demand already.
+            if position not in self.partition_sprites:
+                self.add_partition(position, pixels)
+            self.partitions_left -= 1
+            if time.time() - start > time_budget:
+                break
+        
+        # Raise errors from the loader in the main thread.
+        if self.loader.error is not None:
+            exc_type, exc_value, exc_traceback = self.loader.error
+            raise exc_type, exc_value, exc_traceback
+        
+        if self.size is None:
+            return None
+        
+        if self.partitions_left == 0 and len(self.preload_list) == len(self.partition_list):
+            # Every partition fits in the texture budget, so the pixels are
+            # never needed again.
             self.track_image = None # release image for garbage collection
-        return partitions_left
+        return self.partitions_left
+    
+    def stream_partitions(self, dt):
+        """Uploads the remaining partitions one per frame once the race
+           scene has started."""
+        if self.load_partitions(time_budget=0) == 0:
+            self.unschedule(self.stream_partitions)
+    
+    def on_enter(self):
+        super(Track, self).on_enter()
+        
+        if self.partitions_left:
+            self.schedule(self.stream_partitions)
+    
+    def visit(self):
+        self.update_residency()
+        self.cull_partitions()
+        super(Track, self).visit()
+    
+    def get_view_rect(self, margin):
+        """Returns the (min_x, min_y, max_x, max_y) rectangle in track
+           coordinates visible in the ScrollableLayer containing the track,
+           grown by the margin. Returns None if the layer has no view."""
+        layer = self.parent
+        view_w = getattr(layer, 'view_w', 0)
+        view_h = getattr(layer, 'view_h', 0)
+        if not view_w or not view_h:
+            return None
+        
+        min_x = layer.view_x - self.x - margin
+        min_y = layer.view_y - self.y - margin
+        return (min_x, min_y, min_x + view_w + 2 * margin, min_y + view_h + 2 * margin)
+    
+    def update_residency(self):
+        """Uploads the partitions near the view that are not on the video
+           card, and evicts the least recently used partitions once the
+           texture budget is exceeded. At most one partition is uploaded
+           per frame."""
+        rect = self.get_view_rect(PREFETCH_MARGIN)
+        if rect is None or self.track_image is None:
+            return
+        
+        self.residency.next_frame()
+        
+        wanted = self.get_partitions_in_rect(rect)
+        uploaded = False
+        for position in wanted:
+            if position in self.partition_sprites:
+                self.residency.touch(position)
+            elif not uploaded:
+                self.add_partition(position, self.slice_partition(position))
+                uploaded = True
+        
+        for position in self.residency.get_evictions(wanted):
+            self.remove_partition(position)
+    
+    def cull_partitions(self):
+        """Hides the partitions that are outside the view of the
+           ScrollableLayer containing the track, so they are not drawn. The
+           numbers of drawn and culled partitions are kept for reference."""
+        rect = self.get_view_rect(CULL_MARGIN)
+        
+        # Without a view, e.g. before the first focus is set, draw everything.
+        if rect is None:
+            for z, sprite in self.children:
+                sprite.visible = True
+            self.drawn_partitions = len(self.children)
+            self.culled_partitions = 0
+            return
+        
+        min_x, min_y, max_x, max_y = rect
+        half_size = self.TEXTURE_SIZE / 2
+        
+        drawn = 0
+        for z, sprite in self.children:
+            sprite.visible = (sprite.x - half_size < max_x and min_x < sprite.x + half_size and
+                sprite.y - half_size < max_y and min_y < sprite.y + half_size)
+            if sprite.visible:
+                drawn += 1
+        
+        self.drawn_partitions = drawn
+        self.culled_partitions = len(self.children) - drawn
+    
+    def get_distance_to_start(self, (x, y)):
+        """Returns the distance between the center of a partition and the
+           first position of the starting grid."""
+        (start_x, start_y), rotation = self.get_start()[0]
+        center_x = x + self.TEXTURE_SIZE / 2
+        center_y = y + self.TEXTURE_SIZE / 2
+        return math.hypot(center_x - start_x, center_y - start_y)
+    
+    def get_partitions_in_view(self, (focus_x, focus_y), (width, height)):
+        """Returns the partitions visible in a view of the supplied size
+           centered on the focus. Like the ScrollingManager, the view is
+           kept within the bounds of the track."""
+        view_x = max(0, min(focus_x - width / 2, self.size[0] - width))
+        view_y = max(0, min(focus_y - height / 2, self.size[1] - height))
+        return self.get_partitions_in_rect((view_x, view_y, view_x + width, view_y + height))
+    
+    def get_partitions_in_rect(self, (min_x, min_y, max_x, max_y)):
+        """Returns the positions of the partitions intersecting the
+           rectangle, nearest to the center of the rectangle first."""
+        size = self.TEXTURE_SIZE
+        first_x = max(0, int(min_x) / size)
+        first_y = max(0, int(min_y) / size)
+        last_x = min(self.size[0] / size - 1, int(max_x) / size)
+        last_y = min(self.size[1] / size - 1, int(max_y) / size)
+        
+        center_x = (min_x + max_x) / 2.0 - size / 2
+        center_y = (min_y + max_y) / 2.0 - size / 2
+        
+        partitions = []
+        for x in range(first_x, last_x + 1):
+            for y in range(first_y, last_y + 1):
+                partitions.append((x * size, y * size))
+        partitions.sort(key=lambda (x, y): math.hypot(x - center_x, y - center_y))
+        return partitions
     
     def load_music(self):
         '''Load the track music'''
@@ -117,49 +319,77 @@ class Track(cocos.layer.Layer):
         else:
             self.music = None
     
-    def get_overlay_pixel(self, (x,y)):
-        overlay_y = int((self.size[1] - y) / 4)
-        overlay_x = int(x / 4)
-        rows = ((overlay_y-1) * 4 * int(self.size[0] / 4))
-        pos = int(rows + (overlay_x - 1) * 4)
-        pixel = self.overlay_data[pos:pos+4]
-        return pixel
-    
-    def get_friction_at(self, (x,y)):
-        if 0 < x < self.size[0] and 0 < y < self.size[1]:
-            pixel = self.get_overlay_pixel((x,y))
-            return pixel[2]
-        return 25
-    
-    def get_path_at(self, (x,y)):
-        if 0 < x < self.size[0] and 0 < y < self.size[1]:
-            pixel = self.get_overlay_pixel((x,y))
-            return pixel[0]
-        return 0
-    
-    def get_checkpoint_stage_at(self, (x,y)):
-        if 0 < x < self.size[0] and 0 < y < self.size[1]:
-            pixel = self.get_overlay_pixel((x,y))
-            if 10 < pixel[1] < 100:
-                return 1
-            elif pixel[1] > 125:
-                return 2
-        return 0
-    
     def stop_music(self):
         if self.music is not None:
             self.music.pause()
     
     def get_start(self):
-        return self.start
+        return self.surface.get_start()
     
     def get_checkpoints(self):
-        return self.checkpoints
+        return self.surface.get_checkpoints()
     
     def get_size(self):
         return self.size
     
     def get_laps(self):
-        return self.laps
+        return self.surface.get_laps()
+
+
+class TextureResidency(object):
+    """Keeps track of when the resident partitions of a track were last
+       used, to find the least recently used ones when the number of
+       resident partitions exceeds the capacity."""
+    
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.frame = 0
+        self.last_used = {}
+    
+    def next_frame(self):
+        self.frame += 1
+    
+    def touch(self, position):
+        self.last_used[position] = self.frame
+    
+    def remove(self, position):
+        del self.last_used[position]
     
+    def get_evictions(self, protected):
+        """Returns the least recently used partitions that have to be
+           evicted to get back within capacity. Protected partitions are
+           never returned, even if that means the capacity is exceeded."""
+        excess = len(self.last_used) - self.capacity
+        if excess <= 0:
+            return []
+        
+        candidates = [(frame, position) for position, frame in self.last_used.iteritems()
+            if position not in protected]
+        candidates.sort()
+        return [position for frame, position in candidates[:excess]]
+
+
+class TrackLoader(threading.Thread):
+    """Decodes the track image and the overlay and slices the track image
+       into partitions in the background. The main thread only has to
+       upload the prepared partitions, which are put in the ready queue as
+       (position, pixels) tuples."""
+    
+    def __init__(self, track):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        
+        self.track = track
+        self.ready = Queue.Queue(LOADER_QUEUE_SIZE)
+        
+        # Holds the exc_info tuple if loading failed.
+        self.error = None
     
+    def run(self):
+        try:
+            self.track.load_images()
+            self.track.load_overlay()
+            for position in self.track.preload_list:
+                self.ready.put((position, self.track.slice_partition(position)))
+        except Exception:
+            self.error = sys.exc_info()
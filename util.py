@@ -161,6 +161,138 @@ class Polygon:
         # The projections intersect on all axes, so the polygons are intersecting
         return True
 
+class OrientedBox(object):
+    """A rectangle rotated around its center. The rotation is in radians,
+       counter-clockwise. Only the center, the two unit axes and the half
+       sizes are stored; nothing is allocated during intersection tests."""
+    __slots__ = ('x', 'y', 'ux', 'uy', 'half_width', 'half_height')
+    
+    def __init__(self, x, y, rotation, half_width, half_height):
+        self.x, self.y = x, y
+        # The unit vector along the width. The unit vector along the height
+        # is perpendicular to it: (-uy, ux).
+        self.ux, self.uy = math.cos(rotation), math.sin(rotation)
+        self.half_width, self.half_height = half_width, half_height
+    
+    def to_tuple(self):
+        """Returns the box as a flat tuple, as used by box arrays."""
+        return (self.x, self.y, self.ux, self.uy, self.half_width, self.half_height)
+
+
+def obb_intersects(a, b):
+    """Returns whether two OrientedBox instances intersect. Rectangles only
+       have two distinct edge directions each, so only four axes have to
+       be tested. Boxes that just touch do not intersect, like with
+       Polygon.intersects."""
+    dx = b.x - a.x
+    dy = b.y - a.y
+    
+    # The (absolute) cosine and sine of the angle between both boxes.
+    cos = abs(a.ux * b.ux + a.uy * b.uy)
+    sin = abs(a.ux * b.uy - a.uy * b.ux)
+    
+    # Axes of a.
+    if abs(dx * a.ux + dy * a.uy) >= a.half_width + b.half_width * cos + b.half_height * sin:
+        return False
+    if abs(dy * a.ux - dx * a.uy) >= a.half_height + b.half_width * sin + b.half_height * cos:
+        return False
+    
+    # Axes of b.
+    if abs(dx * b.ux + dy * b.uy) >= b.half_width + a.half_width * cos + a.half_height * sin:
+        return False
+    if abs(dy * b.ux - dx * b.uy) >= b.half_height + a.half_width * sin + a.half_height * cos:
+        return False
+    
+    return True
+
+
+def obb_penetration(a, b):
+    """Returns how far two OrientedBox instances overlap, as a (depth, x, y)
+       tuple, where (x, y) is the unit axis along which b has to be moved
+       by depth to separate the boxes: the minimum translation vector.
+       Returns None if the boxes do not intersect."""
+    dx = b.x - a.x
+    dy = b.y - a.y
+    
+    cos = abs(a.ux * b.ux + a.uy * b.uy)
+    sin = abs(a.ux * b.uy - a.uy * b.ux)
+    
+    # The four axes with the sum of the projected half extents of both boxes.
+    axes = (
+        (a.ux, a.uy, a.half_width + b.half_width * cos + b.half_height * sin),
+        (-a.uy, a.ux, a.half_height + b.half_width * sin + b.half_height * cos),
+        (b.ux, b.uy, b.half_width + a.half_width * cos + a.half_height * sin),
+        (-b.uy, b.ux, b.half_height + a.half_width * sin + a.half_height * cos)
+    )
+    
+    result = None
+    for axis_x, axis_y, reach in axes:
+        distance = dx * axis_x + dy * axis_y
+        depth = reach - abs(distance)
+        if depth <= 0:
+            return None
+        
+        if result is None or depth < result[0]:
+            if distance < 0:
+                axis_x, axis_y = -axis_x, -axis_y
+            result = (depth, axis_x, axis_y)
+    
+    return result
+
+
+def boxes_to_array(boxes):
+    """Converts a list of OrientedBox instances into an N x 6 array."""
+    import numpy
+    
+    return numpy.array([box.to_tuple() for box in boxes], dtype=numpy.float64).reshape((-1, 6))
+
+
+def obb_intersects_many(box, boxes):
+    """Tests one OrientedBox against an N x 6 array of boxes (see
+       boxes_to_array) at once. Returns a boolean array."""
+    import numpy
+    
+    x, y, ux, uy, half_width, half_height = [boxes[:,i] for i in range(6)]
+    dx = x - box.x
+    dy = y - box.y
+    
+    cos = numpy.abs(box.ux * ux + box.uy * uy)
+    sin = numpy.abs(box.ux * uy - box.uy * ux)
+    
+    separated = numpy.abs(dx * box.ux + dy * box.uy) >= box.half_width + half_width * cos + half_height * sin
+    separated |= numpy.abs(dy * box.ux - dx * box.uy) >= box.half_height + half_width * sin + half_height * cos
+    separated |= numpy.abs(dx * ux + dy * uy) >= half_width + box.half_width * cos + box.half_height * sin
+    separated |= numpy.abs(dy * ux - dx * uy) >= half_height + box.half_width * sin + box.half_height * cos
+    
+    return ~separated
+
+
+def find_overlapping_circles(circles):
+    """Broad phase collision detection using sort and sweep. Circles is a
+       list of (x, y, radius) tuples. Returns a list of (i, j) index pairs,
+       with i < j, of the circles that overlap."""
+    order = range(len(circles))
+    order.sort(key=lambda i: circles[i][0] - circles[i][2])
+    
+    pairs = []
+    active = []
+    for i in order:
+        x, y, radius = circles[i]
+        
+        # Drop the circles that end before this one starts on the x axis.
+        active = [j for j in active if circles[j][0] + circles[j][2] >= x - radius]
+        
+        for j in active:
+            other_x, other_y, other_radius = circles[j]
+            reach = radius + other_radius
+            if (x - other_x) ** 2 + (y - other_y) ** 2 <= reach * reach:
+                pairs.append((min(i, j), max(i, j)))
+        
+        active.append(i)
+    
+    return pairs
+
+
 def print_poly(poly):
     for point in poly.points:
         print 'X', point.x, 'Y', point.y